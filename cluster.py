@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+分布式测速 (coordinator / worker)
+- Coordinator：IPTEST_ENGINE=cluster 时由 main.py 启动的内置 HTTP 服务。run_batches 的每个批次交给它排队，
+  由各 worker 领取测速；收回的 CSV 写到批次原本的输出路径，之后的合并、解析、断点日志与本地测速完全相同。
+- worker：在任意主机上运行 `python cluster.py worker --coordinator http://主机:端口`，
+  领取批次后用内置测速器 (native) 或 iptest.exe (exe) 测速并上传结果，测速参数以 coordinator 下发的为准。
+- 协议为 JSON over HTTP，请求头 X-Cluster-Token 携带共享口令：
+  POST /lease      领取一个批次 (长轮询，暂无批次时返回 204)
+  POST /heartbeat  为正在运行的批次续约，响应中带回需要放弃的批次 (已被撤回或已转交他人)
+  POST /result     上传结果 CSV 或错误信息
+- worker 超过 lease_timeout 秒未续约即视为失联，其批次退回队列头部重新分配；失联 worker 迟到的结果会被忽略。
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import requests
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+LONG_POLL_SECONDS = 20
+
+
+class BatchFailed(Exception):
+    """worker 报告批次执行失败 (由 run_batches 的重试逻辑处理)。"""
+
+
+class Coordinator:
+    """批次队列与租约管理。run() 可在多个测速线程中同时调用，每次阻塞到该批次有结果为止。"""
+
+    def __init__(self, host: str, port: int, token: str, lease_timeout: float, params: Dict[str, Any]):
+        self.token = token
+        self.lease_timeout = lease_timeout
+        self.params = params
+        self._tasks: Dict[str, Dict[str, Any]] = {}
+        self._pending: deque = deque()
+        self._workers: Set[str] = set()
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="cluster-coordinator", daemon=True)
+        self._thread.start()
+        logger.info("coordinator 已启动: %s", self.address)
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    # --- 供 run_batches 调用 ---
+    def run(self, lines: List[str], out_path: Path, abort: threading.Event,
+            on_lease: Optional[Callable[[], None]] = None) -> None:
+        """
+        提交一个批次并等待 worker 交回结果 (写入 out_path)。abort 被设置时撤回批次，不写出结果。
+        on_lease 在批次每次被 worker 领取时调用 (失联后重新分配也会再次调用)，供调用方从领取时刻开始计时。
+        """
+        task_id = uuid.uuid4().hex
+        with self._cond:
+            self._tasks[task_id] = {"lines": lines, "out_path": out_path, "state": "pending",
+                                    "worker": None, "deadline": 0.0, "error": None, "on_lease": on_lease}
+            self._pending.append(task_id)
+            self._cond.notify_all()
+            while True:
+                self._reap()
+                task = self._tasks[task_id]
+                if task["state"] == "done":
+                    del self._tasks[task_id]
+                    return
+                if task["state"] == "failed":
+                    del self._tasks[task_id]
+                    raise BatchFailed(f"worker {task['worker']} 执行失败: {task['error']}")
+                if abort.is_set():
+                    # 排队中的直接移出；已领取的在下次心跳时通知 worker 放弃
+                    del self._tasks[task_id]
+                    if task_id in self._pending:
+                        self._pending.remove(task_id)
+                    return
+                self._cond.wait(timeout=1.0)
+
+    def _reap(self) -> None:
+        """把租约过期 (worker 失联) 的批次放回队列头部。调用方需持有锁。"""
+        now = time.time()
+        for task_id, task in self._tasks.items():
+            if task["state"] == "leased" and task["deadline"] < now:
+                print(f"[-] worker {task['worker']} 超过 {self.lease_timeout:g}s 未响应，批次重新分配 ({len(task['lines'])} 个IP)")
+                logger.warning("worker %s 失联，批次 %s 退回队列", task["worker"], task_id)
+                self._workers.discard(task["worker"])
+                task.update(state="pending", worker=None)
+                self._pending.appendleft(task_id)
+                self._cond.notify_all()
+
+    # --- HTTP 接口 ---
+    def lease(self, worker: str) -> Optional[Dict[str, Any]]:
+        deadline = time.time() + LONG_POLL_SECONDS
+        with self._cond:
+            if worker not in self._workers:
+                self._workers.add(worker)
+                print(f"[+] worker {worker} 已连接 (当前 {len(self._workers)} 个)")
+            while True:
+                self._reap()
+                while self._pending:
+                    task_id = self._pending.popleft()
+                    task = self._tasks.get(task_id)
+                    if task is None or task["state"] != "pending":
+                        continue
+                    task.update(state="leased", worker=worker, deadline=time.time() + self.lease_timeout)
+                    if task["on_lease"] is not None:
+                        task["on_lease"]()
+                    return {"task": task_id, "lines": task["lines"], "params": self.params,
+                            "heartbeat": max(1.0, self.lease_timeout / 4)}
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(timeout=min(remaining, 1.0))
+
+    def heartbeat(self, worker: str, task_ids: List[str]) -> List[str]:
+        """续约 worker 仍持有的批次，返回它应当放弃的批次。"""
+        cancel = []
+        with self._cond:
+            self._workers.add(worker)
+            for task_id in task_ids:
+                task = self._tasks.get(task_id)
+                if task is None or task["worker"] != worker or task["state"] != "leased":
+                    cancel.append(task_id)
+                else:
+                    task["deadline"] = time.time() + self.lease_timeout
+        return cancel
+
+    def result(self, worker: str, task_id: str, csv_text: Optional[str], error: Optional[str]) -> bool:
+        """登记 worker 交回的结果；批次已撤回或已转交他人时忽略并返回 False。"""
+        with self._cond:
+            task = self._tasks.get(task_id)
+            if task is None or task["worker"] != worker or task["state"] != "leased":
+                return False
+            if error is not None:
+                task.update(state="failed", error=error)
+            else:
+                task["out_path"].write_text(csv_text or "", encoding='utf-8')
+                task["state"] = "done"
+            self._cond.notify_all()
+            return True
+
+    def _handler_class(self):
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, payload: Optional[Dict[str, Any]] = None) -> None:
+                body = json.dumps(payload).encode('utf-8') if payload is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self) -> None:
+                if coordinator.token and self.headers.get("X-Cluster-Token") != coordinator.token:
+                    self._reply(403, {"error": "invalid token"})
+                    return
+                try:
+                    data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    worker = str(data["worker"])
+                    if self.path == "/lease":
+                        task = coordinator.lease(worker)
+                        if task:
+                            self._reply(200, task)
+                        else:
+                            self._reply(204)
+                    elif self.path == "/heartbeat":
+                        self._reply(200, {"cancel": coordinator.heartbeat(worker, list(data.get("tasks", [])))})
+                    elif self.path == "/result":
+                        accepted = coordinator.result(worker, str(data["task"]), data.get("csv"), data.get("error"))
+                        self._reply(200, {"accepted": accepted})
+                    else:
+                        self._reply(404, {"error": "not found"})
+                except (ValueError, KeyError) as e:
+                    self._reply(400, {"error": str(e)})
+
+            def log_message(self, format: str, *args: Any) -> None:
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+        return Handler
+
+
+# ==============================================================================
+# --- worker ---
+# ==============================================================================
+class Worker:
+    def __init__(self, coordinator_url: str, token: str, slots: int, engine: str, iptest: Path, name: str):
+        self.url = coordinator_url.rstrip('/')
+        self.headers = {"X-Cluster-Token": token}
+        self.slots = max(1, slots)
+        self.engine = engine
+        self.iptest = iptest
+        self.name = name
+        self._active: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._heartbeat = 5.0
+
+    def _post(self, path: str, payload: Dict[str, Any], timeout: float) -> requests.Response:
+        payload["worker"] = self.name
+        response = requests.post(self.url + path, json=payload, headers=self.headers, timeout=timeout)
+        if response.status_code == 403:
+            print("[-] coordinator 拒绝了口令，请检查 CLUSTER_TOKEN。")
+            os._exit(1)
+        response.raise_for_status()
+        return response
+
+    def _run_task(self, task: Dict[str, Any], abort: threading.Event) -> str:
+        """在临时目录中测速一个批次，返回结果 CSV 文本。"""
+        params = task["params"]
+        with tempfile.TemporaryDirectory(prefix='cluster_') as tmp:
+            in_path, out_path = Path(tmp) / "batch.txt", Path(tmp) / "batch.csv"
+            in_path.write_text('\n'.join(task["lines"]), encoding='utf-8')
+            if self.engine == 'native':
+                import native_iptest
+                native_iptest.run_batch_file(
+                    in_path, out_path, url=params["url"], max_conn=int(params["max"]),
+                    speedtest=int(params["speedtest"]), speedlimit=float(params["speedlimit"]),
+                    delay_ms=int(params["delay"]), http_timeout=float(params["http_timeout"]),
+                    download_seconds=float(params["download_seconds"]), abort=abort,
+                )
+            else:
+                cmd = [str(self.iptest), f"-file={in_path}", f"-outfile={out_path}", f"-max={params['max']}",
+                       f"-speedtest={params['speedtest']}", f"-speedlimit={params['speedlimit']}",
+                       f"-delay={params['delay']}", f"-url={params['url']}"]
+                proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+                while proc.poll() is None:
+                    if abort.wait(0.5):
+                        proc.terminate()
+                        proc.wait()
+                if proc.returncode not in (0, None) and not abort.is_set():
+                    raise subprocess.CalledProcessError(proc.returncode, cmd)
+            return out_path.read_text(encoding='utf-8', errors='ignore') if out_path.exists() else ""
+
+    def _heartbeat_loop(self) -> None:
+        while True:
+            time.sleep(self._heartbeat)
+            with self._lock:
+                task_ids = list(self._active)
+            if not task_ids:
+                continue
+            try:
+                cancel = self._post("/heartbeat", {"tasks": task_ids}, timeout=10).json().get("cancel", [])
+            except (requests.RequestException, ValueError) as e:
+                print(f"[-] 心跳失败: {e}")
+                continue
+            with self._lock:
+                for task_id in cancel:
+                    if task_id in self._active:
+                        print(f"[i] 批次 {task_id[:8]} 已被 coordinator 撤回，停止测速")
+                        self._active[task_id].set()
+
+    def _slot_loop(self, slot: int) -> None:
+        while True:
+            try:
+                response = self._post("/lease", {}, timeout=LONG_POLL_SECONDS + 10)
+            except requests.RequestException as e:
+                print(f"[-] 槽位 {slot}: 无法连接 coordinator ({e})，5 秒后重试")
+                time.sleep(5)
+                continue
+            if response.status_code == 204:
+                continue
+            task = response.json()
+            task_id = task["task"]
+            self._heartbeat = float(task.get("heartbeat", self._heartbeat))
+            abort = threading.Event()
+            with self._lock:
+                self._active[task_id] = abort
+            print(f"[*] 槽位 {slot}: 开始测速批次 {task_id[:8]} ({len(task['lines'])} 个IP)")
+            payload: Dict[str, Any]
+            try:
+                payload = {"csv": self._run_task(task, abort)}
+            except Exception as e:
+                payload = {"error": str(e)}
+            finally:
+                with self._lock:
+                    self._active.pop(task_id, None)
+            if abort.is_set():
+                continue
+            payload["task"] = task_id
+            for attempt in range(3):
+                try:
+                    accepted = self._post("/result", payload, timeout=60).json().get("accepted")
+                    print(f"[+] 槽位 {slot}: 批次 {task_id[:8]} 结果已上传" if accepted else
+                          f"[i] 槽位 {slot}: 批次 {task_id[:8]} 已转交他人，结果被忽略")
+                    break
+                except (requests.RequestException, ValueError) as e:
+                    print(f"[-] 槽位 {slot}: 上传结果失败 ({e})，第 {attempt + 1} 次")
+                    time.sleep(2 ** attempt)
+
+    def run(self) -> None:
+        print(f"[*] worker {self.name} 启动: coordinator={self.url}，并发 {self.slots}，引擎 {self.engine}")
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+        threads = [threading.Thread(target=self._slot_loop, args=(i + 1,), daemon=True) for i in range(self.slots)]
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                t.join()
+        except KeyboardInterrupt:
+            print("[i] worker 退出")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="分布式测速 worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="连接 coordinator 领取批次测速")
+    worker.add_argument("--coordinator", default=os.getenv("CLUSTER_COORDINATOR", ""), help="coordinator 地址，如 http://10.0.0.1:8787")
+    worker.add_argument("--token", default=os.getenv("CLUSTER_TOKEN", ""), help="共享口令 (默认读取 CLUSTER_TOKEN)")
+    worker.add_argument("--slots", type=int, default=int(os.getenv("TEST_CONCURRENCY", "2")), help="同时测速的批次数")
+    worker.add_argument("--engine", choices=("native", "exe"), default="native", help="本机测速引擎")
+    worker.add_argument("--iptest", default=str(Path(__file__).parent.resolve() / "iptest.exe"), help="exe 引擎的 iptest 路径")
+    worker.add_argument("--name", default=f"{socket.gethostname()}-{os.getpid()}", help="worker 名称")
+    args = parser.parse_args(argv)
+    if not args.coordinator:
+        parser.error("需要 --coordinator 或环境变量 CLUSTER_COORDINATOR")
+    Worker(args.coordinator, args.token, args.slots, args.engine, Path(args.iptest).resolve(), args.name).run()
+
+
+if __name__ == "__main__":
+    main()
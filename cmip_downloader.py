@@ -7,19 +7,30 @@
     1. 优先尝试从目录名解析端口号。
     2. 如果目录名不是端口，则回退到扫描文件内容，查找 IP:端口/IP 端口 格式。
 - [健壮] 增加了完整的错误处理、下载进度条和自动清理功能。
+- [优化] 默认以流式方式逐个读取ZIP成员并按块解析，不再解压到磁盘。
+- [缓存] 压缩包持久缓存于 cmip_cache，使用条件请求与断点续传；上游未变化时直接复用上次的解析结果。
+- [增量] 压缩包有更新时，按成员 CRC 只重新解析发生变化的成员。
+- [性能] 解析直接在字节缓冲区 (mmap 或解压块) 上运行字节级正则，只在输出时还原IP文本。
+- [接口] iter_endpoints() 供主流程在同一进程内直接调用，逐个产出提取结果，无需启动子进程。
 """
+import hashlib
+import json
+import mmap
 import os
 import time
 import re
 import sys
 import shutil
 import zipfile
-from pathlib import Path
-from typing import Set
+from pathlib import Path, PurePosixPath
+from typing import Any, BinaryIO, Dict, Optional
 
 import requests
 from dotenv import load_dotenv
 
+import ip_history
+from endpoints import EndpointSet, EndpointStream
+
 try:
     from tqdm import tqdm
 except ImportError:
@@ -32,36 +43,125 @@ except ImportError:
 load_dotenv()
 # [新增] 从.env文件读取下载URL
 CMIP_ZIP_URL = os.getenv("CMIP_ZIP_URL")
+# 解析方式：stream 直接流式读取ZIP成员 (默认，无磁盘写入)；disk 先解压到临时目录再扫描
+CMIP_EXTRACT_MODE = os.getenv("CMIP_EXTRACT_MODE", "stream").strip().lower()
 
 BASE_DIR = Path(__file__).parent.resolve()
 OUTPUT_FILENAME = "ip.txt"
 TEMP_DIR = BASE_DIR / "temp_cmip_download"
+# 持久化下载缓存：压缩包、HTTP 校验信息与上次解析出的候选集合跨运行保留
+CACHE_DIR = BASE_DIR / "cmip_cache"
+CACHE_ZIP = CACHE_DIR / "download.zip"
+CACHE_META_JSON = CACHE_DIR / "cache_meta.json"
+CANDIDATES_CACHE = CACHE_DIR / "candidates.bin"
+# 成员索引：按成员名记录中央目录中的 CRC/大小及其解析结果文件，用于增量解析。
+# 各成员的解析结果与 candidates.bin 相同，为打包键的二进制文件，存放在 MEMBER_CACHE_DIR 中
+MEMBER_INDEX_JSON = CACHE_DIR / "member_index.json"
+MEMBER_CACHE_DIR = CACHE_DIR / "members"
+MEMBER_INDEX_VERSION = 3
+
+def load_cache_meta() -> Dict[str, Any]:
+    """读取下载缓存元数据 (ETag/Last-Modified 等)，不存在或损坏时返回空字典。"""
+    try:
+        return json.loads(CACHE_META_JSON.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+def save_cache_meta(meta: Dict[str, Any]) -> None:
+    CACHE_META_JSON.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding='utf-8')
+
+def finish_download(part_path: Path, dest_path: Path, meta: Dict[str, Any]) -> str:
+    """把下载完成的 .part 文件改名为正式缓存，并把续传校验信息转为条件请求使用的校验信息。"""
+    os.replace(part_path, dest_path)
+    # 新压缩包尚未解析，旧的候选缓存随之失效
+    if CANDIDATES_CACHE.exists():
+        CANDIDATES_CACHE.unlink()
+    partial = meta.pop("partial", {})
+    meta["etag"] = partial.get("etag")
+    meta["last_modified"] = partial.get("last_modified")
+    save_cache_meta(meta)
+    print(f"[+] 下载成功: {dest_path}")
+    return "downloaded"
 
-def download_file(url: str, dest_path: Path):
-    """带进度条的文件下载函数。"""
+def download_file(url: str, dest_path: Path) -> Optional[str]:
+    """
+    带进度条、条件请求与断点续传的文件下载函数。
+    - 已有完整缓存时携带 If-None-Match / If-Modified-Since，上游未变化只需一次 304 往返。
+    - 存在未完成的 .part 文件时以 Range + If-Range 续传，上游已变化则自动从头下载；
+      .part 实际已完整时服务器返回 416，按 Content-Range 核对长度后直接使用。
+    返回 "downloaded" / "not_modified"，失败时返回 None。
+    """
     print(f"[*] 正在从 {url} 下载文件...")
+    part_path = dest_path.with_name(dest_path.name + ".part")
+    meta = load_cache_meta()
+    if meta.get("url") != url:
+        meta = {"url": url}
     attempts = 0
     while attempts < 3:
         attempts += 1
+        headers: Dict[str, str] = {}
+        resume_from = part_path.stat().st_size if part_path.exists() else 0
+        partial = meta.get("partial") or {}
+        validator = partial.get("etag") or partial.get("last_modified")
+        if resume_from and validator:
+            headers["Range"] = f"bytes={resume_from}-"
+            headers["If-Range"] = validator
+        else:
+            resume_from = 0
+            if dest_path.exists() and CANDIDATES_CACHE.exists():
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
         try:
-            with requests.get(url, stream=True, timeout=60) as r:
+            with requests.get(url, stream=True, timeout=60, headers=headers) as r:
+                if r.status_code == 304:
+                    print("[+] 上游文件未变化 (304)，直接复用本地缓存。")
+                    return "not_modified"
+                if r.status_code == 416 and resume_from:
+                    # 请求的起点已超出文件末尾：.part 可能已下载完整 (上次在改名前被终止)，否则作废重下
+                    total = r.headers.get("Content-Range", "").rpartition("/")[2]
+                    if total.isdigit() and int(total) == resume_from:
+                        print("[+] 未完成的下载实际已完整，直接使用。")
+                        return finish_download(part_path, dest_path, meta)
+                    print("[-] 未完成的下载与上游文件不一致，将从头下载。")
+                    part_path.unlink()
+                    meta.pop("partial", None)
+                    attempts -= 1
+                    continue
                 r.raise_for_status()
-                total_size = int(r.headers.get('content-length', 0))
-                with dest_path.open('wb') as f, tqdm(
-                    total=total_size, unit='iB', unit_scale=True, desc=dest_path.name
+                if r.status_code != 206:
+                    resume_from = 0
+                meta["partial"] = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+                save_cache_meta(meta)
+                total_size = int(r.headers.get('content-length', 0)) + resume_from
+                if resume_from:
+                    print(f"[*] 从第 {resume_from} 字节处继续下载...")
+                with part_path.open('ab' if resume_from else 'wb') as f, tqdm(
+                    total=total_size, initial=resume_from, unit='iB', unit_scale=True, desc=dest_path.name
                 ) as bar:
                     for chunk in r.iter_content(chunk_size=8192):
                         f.write(chunk)
                         bar.update(len(chunk))
-            print(f"[+] 下载成功: {dest_path}")
-            return True
+            return finish_download(part_path, dest_path, meta)
         except requests.exceptions.RequestException as e:
             print(f"[-] 下载失败(尝试 {attempts}): {e}")
             if attempts < 3:
                 time.sleep(2)
             else:
                 print(f"[-] [致命错误] 下载文件失败: {e}")
-                return False
+                return None
+
+def load_cached_candidates() -> Optional[EndpointSet]:
+    """读取上次解析得到的候选IP集合 (打包键的二进制文件)，缺失或损坏时返回 None (按未命中处理)。"""
+    try:
+        return EndpointSet.load(CANDIDATES_CACHE)
+    except (OSError, ValueError) as e:
+        print(f"[-] 候选缓存不可用，将重新解析压缩包: {e}")
+        return None
+
+def save_cached_candidates(found_ips: EndpointSet) -> None:
+    found_ips.save(CANDIDATES_CACHE)
 
 def extract_zip(zip_path: Path, extract_to: Path):
     """解压ZIP文件。"""
@@ -78,13 +178,153 @@ def extract_zip(zip_path: Path, extract_to: Path):
         print(f"[-] [致命错误] 解压时发生未知错误: {e}")
         return False
 
-def process_extracted_files(extract_dir: Path) -> Set[str]:
+# 通用扫描正则 (字节级)：IP 后跟 冒号/空白/逗号 与端口。分隔符不跨越换行，一个端点只在一行之内
+GENERAL_PATTERN = re.compile(rb"(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})[:,\t\x0b\x0c ]+(\d{1,5})")
+IP_PATTERN = re.compile(rb"(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})")
+# 流式读取ZIP成员时每次读入的块大小
+READ_BLOCK = 1024 * 1024
+
+def port_from_dir_name(dir_name: str) -> Optional[str]:
+    """策略一：目录名为合法端口号时返回该端口。"""
+    if dir_name.isdigit() and 1 <= int(dir_name) <= 65535:
+        return dir_name
+    return None
+
+def pack_octets(a: bytes, b: bytes, c: bytes, d: bytes, port: int) -> Optional[int]:
+    """直接由匹配到的字节八位组打包为整数键 (无需解码)；越界时返回 None。"""
+    a, b, c, d = int(a), int(b), int(c), int(d)
+    if a > 255 or b > 255 or c > 255 or d > 255 or not 0 < port <= 65535:
+        return None
+    return (((a << 24) | (b << 16) | (c << 8) | d) << 16) | port
+
+def scan_buffer(buf, port_from_dir: Optional[int], unique_ips: EndpointSet, end: Optional[int] = None) -> None:
+    """
+    在字节缓冲区 (bytes 或 mmap) 上直接运行字节级正则，只扫描到 end 为止。
+    目录名是端口时只匹配IP并套用该端口；否则回退到通用扫描，查找 IP:端口/IP 端口 格式。
+    (通用格式必然包含IP，因此目录端口模式下无需再回退。)
+    """
+    end = len(buf) if end is None else end
+    if port_from_dir:
+        for m in IP_PATTERN.finditer(buf, 0, end):
+            key = pack_octets(*m.groups(), port_from_dir)
+            if key is not None:
+                unique_ips.add(key)
+    else:
+        for m in GENERAL_PATTERN.finditer(buf, 0, end):
+            a, b, c, d, port = m.groups()
+            key = pack_octets(a, b, c, d, int(port))
+            if key is not None:
+                unique_ips.add(key)
+
+def scan_stream(raw: BinaryIO, port_from_dir: Optional[int], unique_ips: EndpointSet) -> None:
+    """按块读取解压流，在最后一个换行处截断后扫描，剩余半行并入下一块，内存占用与成员大小无关。"""
+    tail = b""
+    while True:
+        block = raw.read(READ_BLOCK)
+        if not block:
+            break
+        if tail:
+            block = tail + block
+        cut = block.rfind(b"\n") + 1
+        scan_buffer(block, port_from_dir, unique_ips, cut)
+        tail = block[cut:]
+    if tail:
+        scan_buffer(tail, port_from_dir, unique_ips)
+
+def scan_file_mmap(file_path: Path, port_from_dir: Optional[int], unique_ips: EndpointSet) -> None:
+    """将文件 mmap 后直接做字节级扫描，不产生完整的解码副本。"""
+    if file_path.stat().st_size == 0:
+        return
+    with file_path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        scan_buffer(buf, port_from_dir, unique_ips)
+
+def load_member_index() -> Dict[str, Dict[str, Any]]:
+    """读取成员索引：成员名 -> {crc, size, file}。版本不符或损坏时视为空。"""
+    try:
+        data = json.loads(MEMBER_INDEX_JSON.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+    if data.get("version") != MEMBER_INDEX_VERSION:
+        return {}
+    return data.get("members", {})
+
+def save_member_index(members: Dict[str, Dict[str, Any]]) -> None:
+    MEMBER_INDEX_JSON.write_text(
+        json.dumps({"version": MEMBER_INDEX_VERSION, "members": members}, ensure_ascii=False),
+        encoding='utf-8',
+    )
+
+def member_cache_file(member_name: str) -> str:
+    """成员解析结果的文件名 (按成员名哈希命名，避免路径字符问题)。"""
+    return hashlib.sha1(member_name.encode('utf-8')).hexdigest() + ".bin"
+
+def prune_member_cache(members: Dict[str, Dict[str, Any]]) -> None:
+    """删除索引中已不再引用的成员结果文件 (成员已从压缩包中移除)。"""
+    referenced = {entry["file"] for entry in members.values()}
+    for path in MEMBER_CACHE_DIR.glob("*.bin"):
+        if path.name not in referenced:
+            path.unlink()
+
+def process_zip_members(zip_path: Path, unique_ips: Optional[EndpointSet] = None) -> EndpointSet:
+    """
+    [流式解析] 直接遍历 ZipFile.infolist()，逐个成员按块读取并做字节级扫描，
+    端口同样取自成员的父目录名，整个过程不向磁盘写入任何解压文件。
+    [增量] 中央目录自带每个成员的 CRC 与大小，与成员索引一致的成员直接合并上次的结果，
+    只有发生变化的成员才会被解压和扫描。各成员的结果以打包键二进制文件单独保存，复用时逐个读入，
+    索引本身只记录 CRC、大小与文件名。
+    """
+    if unique_ips is None:
+        unique_ips = EndpointSet()
+    print(f"[*] 正在流式解析压缩包: {zip_path.name}...")
+    old_index = load_member_index()
+    MEMBER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    new_index: Dict[str, Dict[str, Any]] = {}
+    reused = 0
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            members = [info for info in zf.infolist()
+                       if not info.is_dir() and info.filename.lower().endswith('.txt')]
+            if not members:
+                print("[!] 在压缩包中未找到任何 .txt 文件。")
+                return unique_ips
+            for info in tqdm(members, desc="处理文件", unit="个"):
+                cached = old_index.get(info.filename)
+                if cached and cached.get("crc") == info.CRC and cached.get("size") == info.file_size:
+                    try:
+                        unique_ips.update(EndpointSet.load(MEMBER_CACHE_DIR / cached["file"]).keys())
+                        new_index[info.filename] = cached
+                        reused += 1
+                        continue
+                    except (OSError, KeyError, ValueError):
+                        pass    # 结果文件缺失或损坏，重新解析该成员
+                try:
+                    member_ips = EndpointSet()
+                    port_from_dir = port_from_dir_name(PurePosixPath(info.filename).parent.name)
+                    with zf.open(info) as raw:
+                        scan_stream(raw, int(port_from_dir) if port_from_dir else None, member_ips)
+                    unique_ips.update(member_ips.keys())
+                    cache_file = member_cache_file(info.filename)
+                    member_ips.save(MEMBER_CACHE_DIR / cache_file)
+                    new_index[info.filename] = {"crc": info.CRC, "size": info.file_size, "file": cache_file}
+                except Exception as e:
+                    tqdm.write(f"[-] 处理成员 '{info.filename}' 时出错: {e}")
+    except zipfile.BadZipFile:
+        print(f"[-] [致命错误] 文件不是一个有效的ZIP压缩包或已损坏。")
+        return unique_ips
+    print(f"[+] 共 {len(members)} 个成员，其中 {reused} 个未变化直接复用，{len(members) - reused} 个重新解析。")
+    try:
+        save_member_index(new_index)
+        prune_member_cache(new_index)
+    except OSError as e:
+        print(f"[-] 保存成员索引失败: {e}")
+    return unique_ips
+
+def process_extracted_files(extract_dir: Path, unique_ips: Optional[EndpointSet] = None) -> EndpointSet:
     """
     [核心智能逻辑] 遍历解压后的目录并提取IP和端口。
     """
-    unique_ips: Set[str] = set()
-    # 通用扫描正则表达式
-    general_pattern = re.compile(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})[:\s,]+(\d{1,5})")
+    if unique_ips is None:
+        unique_ips = EndpointSet()
 
     print("[*] 开始智能扫描解压目录...")
     # 查找所有.txt文件
@@ -96,59 +336,53 @@ def process_extracted_files(extract_dir: Path) -> Set[str]:
 
     for file_path in tqdm(txt_files, desc="处理文件", unit="个"):
         try:
-            # 策略一：尝试从父目录名获取端口
-            parent_dir_name = file_path.parent.name
-            port_from_dir = None
-            if parent_dir_name.isdigit() and 1 <= int(parent_dir_name) <= 65535:
-                port_from_dir = parent_dir_name
-                
-            with file_path.open('r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-
-            if port_from_dir:
-                # 如果目录名是端口，则假定文件内都是IP地址
-                # 使用更简单的IP匹配，避免误匹配
-                ip_pattern = re.compile(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})")
-                found_in_dir_mode = False
-                for ip_match in ip_pattern.finditer(content):
-                    unique_ips.add(f"{ip_match.group(1)} {port_from_dir}")
-                    found_in_dir_mode = True
-                if found_in_dir_mode:
-                    continue # 如果此模式成功，则处理下一个文件
-
-            # 策略二：如果策略一失败或未找到IP，则回退到通用扫描
-            for match in general_pattern.finditer(content):
-                unique_ips.add(f"{match.group(1)} {match.group(2)}")
-
+            # 策略一：尝试从父目录名获取端口；策略二：回退到通用扫描
+            port_from_dir = port_from_dir_name(file_path.parent.name)
+            scan_file_mmap(file_path, int(port_from_dir) if port_from_dir else None, unique_ips)
         except Exception as e:
             tqdm.write(f"[-] 处理文件 '{file_path}' 时出错: {e}")
             
     return unique_ips
 
-def main():
-    """脚本主流程。"""
+def main(sink: Optional[EndpointSet] = None):
+    """脚本主流程。sink 为收集结果的集合，流水线模式下传入流式输出的集合。"""
     if not CMIP_ZIP_URL:
         print("[-] [致命错误] 未在 .env 文件中配置 CMIP_ZIP_URL。")
         sys.exit(1)
 
-    # 1. 清理并创建临时目录
+    # 1. 准备缓存目录，清理上次遗留的临时解压目录
     if TEMP_DIR.exists():
         shutil.rmtree(TEMP_DIR)
-    TEMP_DIR.mkdir()
+    CACHE_DIR.mkdir(exist_ok=True)
 
-    zip_file_path = TEMP_DIR / "download.zip"
+    zip_file_path = CACHE_ZIP
 
     try:
-        # 2. 下载文件
-        if not download_file(CMIP_ZIP_URL, zip_file_path):
+        # 2. 下载文件 (条件请求/断点续传)
+        status = download_file(CMIP_ZIP_URL, zip_file_path)
+        if not status:
             sys.exit(1)
 
-        # 3. 解压文件
-        if not extract_zip(zip_file_path, TEMP_DIR):
-            sys.exit(1)
-
-        # 4. 智能处理数据
-        found_ips = process_extracted_files(TEMP_DIR)
+        # 3-4. 解析数据：上游未变化时复用缓存结果；默认流式读取ZIP成员；disk 模式先解压再扫描
+        cached = load_cached_candidates() if status == "not_modified" else None
+        if cached is not None:
+            found_ips = sink if sink is not None else EndpointSet()
+            found_ips.update(cached.keys())
+            print(f"[+] 已从缓存载入 {len(found_ips)} 条候选IP，跳过解析。")
+        elif CMIP_EXTRACT_MODE == "disk":
+            TEMP_DIR.mkdir()
+            if not extract_zip(zip_file_path, TEMP_DIR):
+                sys.exit(1)
+            found_ips = process_extracted_files(TEMP_DIR, sink)
+        else:
+            if not zipfile.is_zipfile(zip_file_path):
+                print(f"[-] [致命错误] 文件不是一个有效的ZIP压缩包或已损坏。")
+                zip_file_path.unlink()
+                sys.exit(1)
+            found_ips = process_zip_members(zip_file_path, sink)
+        if cached is None:
+            save_cached_candidates(found_ips)
+        found_ips = ip_history.filter_suppressed(found_ips)
 
         output_path = BASE_DIR / OUTPUT_FILENAME
         if not found_ips:
@@ -156,14 +390,11 @@ def main():
             output_path.touch() # 创建空文件以保证主流程继续
             return
 
-        # 5. 排序并保存结果
-        sorted_ips = sorted(list(found_ips), key=lambda x: [int(part) for part in x.split(' ')[0].split('.')])
-        with output_path.open('w', encoding='utf-8') as f:
-            for item in sorted_ips:
-                f.write(item + '\n')
+        # 5. 保存结果 (打包键天然按 IP 数值有序)
+        found_ips.write(output_path)
 
         print("\n" + "[SUCCESS]" * 5)
-        print(f"[+] 模式二处理完成！共提取 {len(sorted_ips)} 条唯一IP记录。")
+        print(f"[+] 模式二处理完成！共提取 {len(found_ips)} 条唯一IP记录。")
         print(f"    结果已保存至: '{output_path.name}'")
         print("[SUCCESS]" * 5)
 
@@ -174,5 +405,12 @@ def main():
             shutil.rmtree(TEMP_DIR)
             print("[+] 清理完成。")
 
+def iter_endpoints(maxsize: int = 0) -> EndpointStream:
+    """
+    [库接口] 在当前进程内运行完整提取流程，从下载的压缩包中逐个产出新提取到的IP (打包整数键)。
+    冷却期内的IP不会产出；ip.txt 仍在结束时写出。maxsize 为内部队列容量，0 表示不限。
+    """
+    return EndpointStream(main, ip_history.suppressed_keys(), maxsize)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+紧凑的候选IP容器
+- 每个 IP:端口 打包为一个 48 位整数键 (IPv4 << 16 | 端口)，连续存放在 array('Q') 中，
+  取代 "1.2.3.4 443" 形式的字符串集合。
+- 键的数值顺序即 IP 数值顺序 (同IP再按端口)，排序不再需要逐个 split/int。
+- 提供去重、排序与集合并/差运算；安装了 NumPy 时自动使用向量化实现。
+- StreamingEndpointSet 在收集的同时把首次出现的键交给回调，供提取与测速的流水线使用。
+- EndpointStream 把推送式的提取流程包装为迭代器，供主流程在同一进程内调用提取模块。
+"""
+import bisect
+import heapq
+import os
+import queue
+import socket
+import threading
+from array import array
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 未整理缓冲区的上限，超过后立即排序去重，防止大量重复键占用内存
+PENDING_LIMIT = 1 << 20
+
+
+def pack(ip: str, port: int) -> int:
+    """将已校验的 IPv4 字符串与端口打包为整数键。"""
+    a, b, c, d = ip.split('.')
+    return (((int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d)) << 16) | port
+
+
+def unpack(key: int) -> Tuple[str, int]:
+    return socket.inet_ntoa((key >> 16).to_bytes(4, 'big')), key & 0xFFFF
+
+
+def format_key(key: int) -> str:
+    """还原为 iptest 输入格式 'IP 端口'。"""
+    return f"{socket.inet_ntoa((key >> 16).to_bytes(4, 'big'))} {key & 0xFFFF}"
+
+
+def parse_line(line: str) -> Optional[int]:
+    """解析 'IP 端口' 格式的一行，格式不合法时返回 None。"""
+    parts = line.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return None
+    octets = parts[0].split('.')
+    if len(octets) != 4 or not all(o.isdigit() and int(o) <= 255 for o in octets):
+        return None
+    port = int(parts[1])
+    if not 1 <= port <= 65535:
+        return None
+    return pack(parts[0], port)
+
+
+def _sorted_unique(keys: array) -> array:
+    if np is not None:
+        out = array('Q')
+        out.frombytes(np.unique(np.frombuffer(keys, dtype=np.uint64)).tobytes())
+        return out
+    return array('Q', sorted(set(keys)))
+
+
+def _merge_unique(a: Iterable[int], b: Iterable[int]) -> array:
+    out = array('Q')
+    last = -1
+    for key in heapq.merge(a, b):
+        if key != last:
+            out.append(key)
+            last = key
+    return out
+
+
+class EndpointSet:
+    """以打包整数键存储的有序去重IP集合。"""
+
+    __slots__ = ("_keys", "_pending")
+
+    def __init__(self, keys: Iterable[int] = ()):
+        self._keys = array('Q')
+        self._pending = array('Q', keys)
+        if self._pending:
+            self._compact()
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str]) -> "EndpointSet":
+        result = cls()
+        for line in lines:
+            key = parse_line(line)
+            if key is not None:
+                result.add(key)
+        return result
+
+    @classmethod
+    def read_file(cls, path: Path) -> "EndpointSet":
+        """读取 iptest 格式 (每行 'IP 端口') 的文本文件。"""
+        with path.open('r', encoding='utf-8', errors='ignore') as f:
+            return cls.from_lines(f)
+
+    @classmethod
+    def load(cls, path: Path) -> "EndpointSet":
+        """读取 save() 写出的二进制键文件；文件长度不是 8 的倍数 (损坏) 时抛出 ValueError。"""
+        result = cls()
+        with path.open('rb') as f:
+            result._keys.frombytes(f.read())
+        return result
+
+    def save(self, path: Path) -> None:
+        """写出二进制键文件：先写临时文件再原子替换，进程中途被终止也不会留下不完整的文件。"""
+        self._compact()
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open('wb') as f:
+            self._keys.tofile(f)
+        os.replace(tmp_path, path)
+
+    def add(self, key: int) -> None:
+        self._pending.append(key)
+        if len(self._pending) >= PENDING_LIMIT:
+            self._compact()
+
+    def add_endpoint(self, ip: str, port: int) -> None:
+        self.add(pack(ip, port))
+
+    def update(self, keys: Iterable[int]) -> None:
+        self._pending.extend(keys)
+        if len(self._pending) >= PENDING_LIMIT:
+            self._compact()
+
+    def _compact(self) -> None:
+        if not self._pending:
+            return
+        pending = _sorted_unique(self._pending)
+        self._pending = array('Q')
+        if not self._keys:
+            self._keys = pending
+        elif np is not None:
+            merged = np.union1d(np.frombuffer(self._keys, dtype=np.uint64), np.frombuffer(pending, dtype=np.uint64))
+            self._keys = array('Q')
+            self._keys.frombytes(merged.tobytes())
+        else:
+            self._keys = _merge_unique(self._keys, pending)
+
+    def keys(self) -> array:
+        """已排序去重的键数组 (只读使用)。"""
+        self._compact()
+        return self._keys
+
+    def __len__(self) -> int:
+        self._compact()
+        return len(self._keys)
+
+    def __bool__(self) -> bool:
+        return bool(self._keys) or bool(self._pending)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.keys())
+
+    def __contains__(self, key: int) -> bool:
+        keys = self.keys()
+        i = bisect.bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
+
+    def union(self, other: "EndpointSet") -> "EndpointSet":
+        result = EndpointSet()
+        a, b = self.keys(), other.keys()
+        if np is not None:
+            result._keys.frombytes(np.union1d(np.frombuffer(a, dtype=np.uint64), np.frombuffer(b, dtype=np.uint64)).tobytes())
+        else:
+            result._keys = _merge_unique(a, b)
+        return result
+
+    def difference(self, other: "EndpointSet") -> "EndpointSet":
+        result = EndpointSet()
+        a, b = self.keys(), other.keys()
+        if np is not None:
+            result._keys.frombytes(np.setdiff1d(np.frombuffer(a, dtype=np.uint64), np.frombuffer(b, dtype=np.uint64), assume_unique=True).tobytes())
+        else:
+            result._keys = array('Q', (key for key in a if key not in other))
+        return result
+
+    def intersection(self, other: "EndpointSet") -> "EndpointSet":
+        result = EndpointSet()
+        a, b = self.keys(), other.keys()
+        if np is not None:
+            result._keys.frombytes(np.intersect1d(np.frombuffer(a, dtype=np.uint64), np.frombuffer(b, dtype=np.uint64), assume_unique=True).tobytes())
+        else:
+            result._keys = array('Q', (key for key in a if key in other))
+        return result
+
+    def select_ranges(self, ranges: Iterable[Tuple[int, int]]) -> "EndpointSet":
+        """保留落在给定闭区间 [起, 止] 内的键；区间需按升序排列且互不重叠，每个区间只做两次二分查找。"""
+        result = EndpointSet()
+        keys = self.keys()
+        for start, end in ranges:
+            lo = bisect.bisect_left(keys, start)
+            result._keys.extend(keys[lo:bisect.bisect_right(keys, end, lo)])
+        return result
+
+    __or__ = union
+    __sub__ = difference
+    __and__ = intersection
+
+    def lines(self) -> Iterator[str]:
+        """按 IP 数值顺序输出 'IP 端口' 行 (不含换行符)。"""
+        return (format_key(key) for key in self.keys())
+
+    def to_endpoints(self) -> List[Tuple[str, int]]:
+        return [unpack(key) for key in self.keys()]
+
+    def write(self, path: Path) -> int:
+        """写出为 iptest 输入格式的文本文件，返回行数。"""
+        with path.open('w', encoding='utf-8') as f:
+            for line in self.lines():
+                f.write(line + '\n')
+        return len(self._keys)
+
+
+class StreamingEndpointSet(EndpointSet):
+    """
+    边收集边输出的集合：每个键第一次加入时立即交给 emit 回调，之后的行为与 EndpointSet 相同。
+    skip 中的键 (例如冷却期内的IP) 照常收集但不会输出。
+    判重只查已整理的有序键 (二分查找) 与未整理缓冲区中的新键，缓冲区在整理时清空，
+    因此额外内存以 PENDING_LIMIT 为上限，不随收集的键数增长。
+    """
+
+    __slots__ = ("_emit", "_skip", "_fresh")
+
+    def __init__(self, emit: Callable[[int], None], skip: Iterable[int] = ()):
+        self._fresh: set = set()
+        super().__init__()
+        self._emit = emit
+        self._skip = (skip if isinstance(skip, EndpointSet) else EndpointSet(skip)).keys()
+
+    def add(self, key: int) -> None:
+        # 热路径：判重与 skip 查询内联，避免每个键多次方法调用
+        if key in self._fresh:
+            return
+        keys = self._keys
+        if keys:
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                return
+        self._fresh.add(key)
+        skip = self._skip
+        suppressed = False
+        if skip:
+            i = bisect.bisect_left(skip, key)
+            suppressed = i < len(skip) and skip[i] == key
+        if not suppressed:
+            self._emit(key)
+        self._pending.append(key)
+        if len(self._pending) >= PENDING_LIMIT:
+            self._compact()
+
+    def update(self, keys: Iterable[int]) -> None:
+        for key in keys:
+            self.add(key)
+
+    def _compact(self) -> None:
+        super()._compact()
+        self._fresh.clear()
+
+
+class ExtractionError(RuntimeError):
+    """提取流程执行失败 (包括提取函数内部调用 sys.exit 退出)。"""
+
+
+class EndpointStream:
+    """
+    在后台线程中运行推送式的提取函数 extract(sink)，把 sink 中首次出现的键经有界队列交给迭代方。
+    队列满时提取线程阻塞 (背压)；提取函数抛出的异常在全部键被取走后以 ExtractionError 重新抛出。
+    迭代方提前停止时需调用 drain() 取走剩余的键，否则提取线程会一直阻塞在满队列上。
+    """
+
+    def __init__(self, extract: Callable[[EndpointSet], Any], skip: Iterable[int] = (), maxsize: int = 0):
+        self._queue: "queue.Queue[Optional[int]]" = queue.Queue(maxsize)
+        self._error: Optional[BaseException] = None
+        self._ended = False
+        self._thread = threading.Thread(target=self._run, args=(extract, EndpointSet(skip)), name='Extractor', daemon=True)
+        self._thread.start()
+
+    def _run(self, extract: Callable[[EndpointSet], Any], skip: "EndpointSet") -> None:
+        try:
+            extract(StreamingEndpointSet(self._queue.put, skip))
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                self._error = e
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._queue.put(None)
+
+    def _finish(self) -> None:
+        self._thread.join()
+        if isinstance(self._error, SystemExit):
+            raise ExtractionError(f"提取流程退出，返回码: {self._error.code}")
+        if self._error is not None:
+            raise ExtractionError(f"提取流程出错: {self._error}") from self._error
+
+    def _get(self, timeout: Optional[float] = None) -> Optional[int]:
+        key = self._queue.get(timeout=timeout)
+        if key is None:
+            self._ended = True
+        return key
+
+    @property
+    def ended(self) -> bool:
+        """提取线程的结束标记是否已被取走 (队列中不再有键)。"""
+        return self._ended
+
+    def __iter__(self) -> Iterator[int]:
+        while True:
+            key = self._get()
+            if key is None:
+                break
+            yield key
+        self._finish()
+
+    def drain(self) -> Iterator[int]:
+        """取走队列中剩余的键直到提取结束，让提前停止消费后的提取线程能够跑完；已结束时只等待线程退出。"""
+        while not self._ended:
+            key = self._get()
+            if key is not None:
+                yield key
+        self._finish()
+
+    def chunks(self, size: int, linger: float) -> Iterator[List[int]]:
+        """按组产出键：凑满 size 个，或队列空闲超过 linger 秒时放行已有部分。"""
+        chunk: List[int] = []
+        while True:
+            try:
+                key = self._get(linger if chunk else None)
+            except queue.Empty:
+                yield chunk
+                chunk = []
+                continue
+            if key is None:
+                break
+            chunk.append(key)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        self._finish()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+离线 IP -> 国家索引
+- 从本地 CSV 加载 IPv4 网段与国家代码的对应关系，支持两种常见格式：
+  "1.0.0.0/24,AU" (CIDR) 与 "1.0.0.0,1.0.0.255,AU" (起止地址，如 db-ip 的 country-lite)。
+  表头、注释与 IPv6 行自动跳过。
+- 网段按起始地址排序后存放在 array 中，单个查询用 bisect 二分查找。
+- 按国家过滤候选集合时，把允许国家的网段合并成少量区间，再在候选集合的有序键上二分切片，
+  耗时只与区间数有关，与候选数量基本无关。
+- 网段之间应互不重叠 (常见的国家数据库均满足)。
+"""
+import bisect
+import csv
+import socket
+from array import array
+from pathlib import Path
+from typing import Collection, Dict, FrozenSet, List, Optional, Tuple
+
+from endpoints import EndpointSet
+
+
+def _ip_to_int(ip: str) -> int:
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+def _parse_row(row: List[str]) -> Optional[Tuple[int, int, str]]:
+    """解析一行为 (起始地址, 结束地址, 国家代码)，无法识别的行返回 None。"""
+    fields = [field.strip() for field in row if field.strip()]
+    try:
+        if len(fields) >= 2 and '/' in fields[0]:
+            network, prefix = fields[0].split('/')
+            prefix_len = int(prefix)
+            if not 0 <= prefix_len <= 32:
+                return None
+            start = _ip_to_int(network) & ((0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF)
+            return start, start | (0xFFFFFFFF >> prefix_len), fields[1].upper()
+        if len(fields) >= 3:
+            return _ip_to_int(fields[0]), _ip_to_int(fields[1]), fields[2].upper()
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class CountryIndex:
+    """按起始地址排序的网段区间表。"""
+
+    def __init__(self, ranges: List[Tuple[int, int, str]]):
+        ranges.sort()
+        self.codes: List[str] = sorted({code for _, _, code in ranges})
+        code_ids = {code: i for i, code in enumerate(self.codes)}
+        self._starts = array('L', (start for start, _, _ in ranges))
+        self._ends = array('L', (end for _, end, _ in ranges))
+        self._code_ids = array('H', (code_ids[code] for _, _, code in ranges))
+        self._allowed_cache: Dict[Tuple[FrozenSet[str], bool], List[Tuple[int, int]]] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> "CountryIndex":
+        ranges: List[Tuple[int, int, str]] = []
+        with path.open('r', encoding='utf-8-sig', errors='ignore', newline='') as f:
+            for row in csv.reader(f):
+                if not row or row[0].lstrip().startswith('#'):
+                    continue
+                parsed = _parse_row(row)
+                if parsed is not None and parsed[0] <= parsed[1] and len(parsed[2]) == 2:
+                    ranges.append(parsed)
+        return cls(ranges)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def lookup(self, ip: int) -> Optional[str]:
+        """查询一个 IPv4 整数所属的国家代码，不在任何网段内时返回 None。"""
+        i = bisect.bisect_right(self._starts, ip) - 1
+        if i >= 0 and ip <= self._ends[i]:
+            return self.codes[self._code_ids[i]]
+        return None
+
+    def lookup_key(self, key: int) -> Optional[str]:
+        """按打包键 (IPv4 << 16 | 端口) 查询。"""
+        return self.lookup(key >> 16)
+
+    def _merged_ranges(self, countries: FrozenSet[str], keep_unknown: bool) -> List[Tuple[int, int]]:
+        """允许通过的地址区间 (已合并相邻区间)；keep_unknown 时数据库未覆盖的空隙也算在内。"""
+        allowed = {i for i, code in enumerate(self.codes) if code in countries}
+        merged: List[Tuple[int, int]] = []
+
+        def push(start: int, end: int) -> None:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+
+        cursor = 0
+        for start, end, code_id in zip(self._starts, self._ends, self._code_ids):
+            if keep_unknown and start > cursor:
+                push(cursor, start - 1)
+            if code_id in allowed:
+                push(start, end)
+            cursor = max(cursor, end + 1)
+        if keep_unknown and cursor <= 0xFFFFFFFF:
+            push(cursor, 0xFFFFFFFF)
+        return merged
+
+    def filter(self, candidates: EndpointSet, countries: Collection[str], keep_unknown: bool = True) -> EndpointSet:
+        """只保留位于允许国家 (以及 keep_unknown 时未收录网段) 内的候选IP。合并后的区间按参数缓存。"""
+        cache_key = (frozenset(c.upper() for c in countries), keep_unknown)
+        if cache_key not in self._allowed_cache:
+            self._allowed_cache[cache_key] = self._merged_ranges(cache_key[0], keep_unknown)
+        return candidates.select_ranges(
+            (start << 16, (end << 16) | 0xFFFF) for start, end in self._allowed_cache[cache_key])
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+IP测速历史库 (SQLite)
+- 以 ip:port 为键记录每次测速解析出的延迟、速度、国际代码与时间。
+- 主流程据此跳过 TTL 内已成功测速的IP，直接复用其缓存结果。
+- 负缓存：连续多次测速失败的IP进入指数退避冷却期，生成 ip.txt 时被剔除。
+- 全部成功/失败记录还用于估计各IP、/24 网段与端口的成功率，决定测速顺序。
+"""
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from endpoints import EndpointSet, pack
+
+# --- 常量定义 ---
+# 本模块在 main/cmip_downloader 调用 load_dotenv() 之前就被导入，需自行加载 .env，配置才会生效
+load_dotenv()
+BASE_DIR = Path(__file__).parent.resolve()
+DB_PATH = BASE_DIR / "ip_history.db"
+
+# 负缓存配置：连续失败 N 次后冷却，之后每多失败一次冷却时长翻倍 (N 设为 0 关闭)
+NEG_CACHE_THRESHOLD = int(os.getenv("NEG_CACHE_THRESHOLD", "3"))
+NEG_CACHE_COOLDOWN_HOURS = float(os.getenv("NEG_CACHE_COOLDOWN_HOURS", "24"))
+NEG_CACHE_MAX_COOLDOWN_HOURS = float(os.getenv("NEG_CACHE_MAX_COOLDOWN_HOURS", "720"))
+
+Endpoint = Tuple[str, int]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    latency_ms REAL,
+    speed REAL,
+    country TEXT NOT NULL,
+    tested_at REAL NOT NULL,
+    PRIMARY KEY (ip, port)
+);
+CREATE TABLE IF NOT EXISTS failures (
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    fail_count INTEGER NOT NULL,
+    last_failed REAL NOT NULL,
+    retry_after REAL NOT NULL,
+    PRIMARY KEY (ip, port)
+);
+"""
+
+
+def _connect() -> sqlite3.Connection:
+    """打开历史库；新旧IP测速线程各自建立连接，WAL 模式下可并发读写。"""
+    conn = sqlite3.connect(str(DB_PATH), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def record_results(records: Iterable[Dict]) -> int:
+    """
+    写入一批测速结果。每条记录需包含 ip/port/country，可选 latency_ms/speed。
+    同一 ip:port 只保留最新一次结果，返回写入条数。
+    """
+    now = time.time()
+    rows = [
+        (r["ip"], int(r["port"]), r.get("latency_ms"), r.get("speed"), r["country"], now)
+        for r in records
+    ]
+    if not rows:
+        return 0
+    conn = _connect()
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO results (ip, port, latency_ms, speed, country, tested_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def fresh_results(ttl_seconds: float) -> Dict[Endpoint, Dict]:
+    """返回 TTL 内测速成功的全部记录，键为 (ip, port)。"""
+    if ttl_seconds <= 0 or not DB_PATH.exists():
+        return {}
+    cutoff = time.time() - ttl_seconds
+    conn = _connect()
+    try:
+        cursor = conn.execute(
+            "SELECT ip, port, latency_ms, speed, country, tested_at FROM results WHERE tested_at >= ?",
+            (cutoff,),
+        )
+        return {
+            (ip, port): {"ip": ip, "port": port, "latency_ms": latency, "speed": speed,
+                         "country": country, "tested_at": tested_at}
+            for ip, port, latency, speed, country, tested_at in cursor
+        }
+    finally:
+        conn.close()
+
+
+def split_by_ttl(candidates: EndpointSet, ttl_seconds: float) -> Tuple[EndpointSet, List[Dict]]:
+    """将候选IP拆分为 (需要测速的, TTL 内可复用的缓存记录)。"""
+    cached = fresh_results(ttl_seconds)
+    if not cached:
+        return candidates, []
+    by_key = {pack(ip, port): record for (ip, port), record in cached.items()}
+    reused = EndpointSet(key for key in by_key if key in candidates)
+    return candidates - reused, [by_key[key] for key in reused]
+
+
+def quality_history() -> Tuple[List[Tuple[int, Optional[float], Optional[float]]], List[Tuple[int, int]]]:
+    """
+    读取全部历史，供测速排序使用：
+    返回 (成功记录 [(打包键, 延迟ms, 速度MB/s)], 失败记录 [(打包键, 连续失败次数)])。
+    """
+    if not DB_PATH.exists():
+        return [], []
+    conn = _connect()
+    try:
+        results = [(pack(ip, port), latency, speed) for ip, port, latency, speed
+                   in conn.execute("SELECT ip, port, latency_ms, speed FROM results")]
+        failures = [(pack(ip, port), count) for ip, port, count
+                    in conn.execute("SELECT ip, port, fail_count FROM failures")]
+        return results, failures
+    finally:
+        conn.close()
+
+
+def record_outcomes(failed: Iterable[Endpoint], succeeded: Iterable[Endpoint]) -> None:
+    """
+    更新负缓存：成功的IP清零失败计数；失败的IP计数 +1，
+    达到阈值后设置冷却截止时间 = 现在 + min(基础时长 × 2^(计数-阈值), 上限)。
+    """
+    now = time.time()
+    failed_rows = [(ip, int(port), now) for ip, port in failed]
+    succeeded_rows = [(ip, int(port)) for ip, port in succeeded]
+    if not failed_rows and not succeeded_rows:
+        return
+    conn = _connect()
+    try:
+        with conn:
+            conn.executemany("DELETE FROM failures WHERE ip = ? AND port = ?", succeeded_rows)
+            conn.executemany(
+                "INSERT INTO failures (ip, port, fail_count, last_failed, retry_after) VALUES (?, ?, 1, ?, 0) "
+                "ON CONFLICT (ip, port) DO UPDATE SET fail_count = fail_count + 1, last_failed = excluded.last_failed",
+                failed_rows,
+            )
+            if NEG_CACHE_THRESHOLD > 0:
+                conn.execute(
+                    "UPDATE failures SET retry_after = last_failed + "
+                    "MIN(? * (1 << MIN(fail_count - ?, 30)), ?) * 3600 "
+                    "WHERE last_failed = ? AND fail_count >= ?",
+                    (NEG_CACHE_COOLDOWN_HOURS, NEG_CACHE_THRESHOLD, NEG_CACHE_MAX_COOLDOWN_HOURS,
+                     now, NEG_CACHE_THRESHOLD),
+                )
+    finally:
+        conn.close()
+
+
+def suppressed_endpoints() -> Set[Endpoint]:
+    """返回当前仍处于冷却期的IP集合。"""
+    if NEG_CACHE_THRESHOLD <= 0 or not DB_PATH.exists():
+        return set()
+    conn = _connect()
+    try:
+        cursor = conn.execute(
+            "SELECT ip, port FROM failures WHERE fail_count >= ? AND retry_after > ?",
+            (NEG_CACHE_THRESHOLD, time.time()),
+        )
+        return {(ip, port) for ip, port in cursor}
+    finally:
+        conn.close()
+
+
+def suppressed_keys() -> EndpointSet:
+    """冷却期内IP的打包键集合，读取失败时返回空集合 (流水线模式下用于跳过输出)。"""
+    try:
+        return EndpointSet(pack(ip, port) for ip, port in suppressed_endpoints())
+    except sqlite3.Error as e:
+        print(f"[-] 读取负缓存失败，跳过过滤: {e}")
+        return EndpointSet()
+
+
+def filter_suppressed(candidates: EndpointSet) -> EndpointSet:
+    """从候选集合中剔除冷却期内的IP，供生成 ip.txt 前调用。"""
+    try:
+        suppressed = suppressed_endpoints()
+    except sqlite3.Error as e:
+        print(f"[-] 读取负缓存失败，跳过过滤: {e}")
+        return candidates
+    if not suppressed:
+        return candidates
+    kept = candidates - EndpointSet(pack(ip, port) for ip, port in suppressed)
+    if len(kept) < len(candidates):
+        print(f"[i] 负缓存：剔除了 {len(candidates) - len(kept)} 个连续多次测速失败、仍在冷却期的IP。")
+    return kept
@@ -5,12 +5,24 @@ IP地址提取脚本 (最终智能版)
 - [重构] 脚本独立处理文件选择，支持选择一个或多个文件。
 - [新增] 增加了忽略列表，在扫描时自动排除过程/结果文件。
 - [升级] 核心提取逻辑智能化，可自动识别CSV格式并查找对应列。
+- [性能] 单次扫描的编译分词器取代逐行多达四次的级联正则匹配。
+- [性能] 输入较大时启用多进程：大文件按换行对齐切块并行扫描，各进程结果在主进程合并。
+- [接口] iter_endpoints() 供主流程在同一进程内直接调用，逐个产出提取结果，无需启动子进程。
 """
+import multiprocessing
+import os
 import re
 import sys
 import csv
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Set
+from typing import List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+import ip_history
+from endpoints import EndpointSet, EndpointStream, pack
 
 try:
     from tqdm import tqdm
@@ -19,22 +31,44 @@ except ImportError:
         print("提示：未安装tqdm库，无进度条显示。可运行 'pip install tqdm' 安装。")
         return iterable
 
+# 独立运行时同样读取 .env 中的 IPCCC_WORKERS / IPCCC_CHUNK_MB / GEO_DB_PATH
+load_dotenv()
+
 # --- 常量定义 ---
 CURRENT_DIR = Path.cwd()
 OUTPUT_FILENAME = "ip.txt"
+# 多进程提取：进程数与单个分块大小 (MB，最小为 1)；输入总量小于一个分块时仍单进程处理
+IPCCC_WORKERS = int(os.getenv("IPCCC_WORKERS", str(os.cpu_count() or 1)))
+IPCCC_CHUNK_MB = max(1, int(os.getenv("IPCCC_CHUNK_MB", "32")))
 IGNORED_FILENAMES = {
     "new_ip_test_result.csv", "old_ip_test_result.csv", "ip.txt",
-    "api_temp.txt", "final_ip_list.txt", "requirements.txt"
+    "api_temp.txt", "final_ip_list.txt", "requirements.txt",
+    "ip_test_result.csv", "ip_test_result_expand.csv"
 }
 
+def configured_data_files() -> Set[Path]:
+    """
+    配置中引用的数据文件 (离线国家数据库 GEO_DB_PATH)，它们同样是 .csv，但不是IP源。
+    相对路径按脚本所在目录解析，与主流程一致。
+    """
+    geo_db = os.getenv("GEO_DB_PATH", "").strip()
+    if not geo_db:
+        return set()
+    path = Path(geo_db)
+    if not path.is_absolute():
+        path = Path(__file__).parent / path
+    return {path.resolve()}
+
 def find_source_files() -> List[Path]:
-    """在当前目录下查找所有 .txt 和 .csv 文件，并排除忽略列表中的文件。"""
+    """在当前目录下查找所有 .txt 和 .csv 文件，并排除忽略列表中的文件与配置引用的数据文件。"""
     print("[*] 正在扫描源文件...")
+    excluded = configured_data_files()
     source_files = [
         f for f in CURRENT_DIR.iterdir()
         if f.is_file() 
         and f.suffix.lower() in ['.txt', '.csv'] 
         and f.name.lower() not in IGNORED_FILENAMES
+        and f.resolve() not in excluded
     ]
     print(f"[+] 扫描完成，找到 {len(source_files)} 个可处理的源文件。")
     return source_files
@@ -68,153 +102,273 @@ def select_files_from_list(file_list: List[Path]) -> List[Path]:
         except ValueError:
             print("[!] 输入错误，请输入数字。")
 
-def process_files(files_to_process: List[Path], output_file: Path) -> None:
-    """[核心升级] 从指定的文件列表中提取IP和端口，智能处理多种格式。"""
-    unique_ips: Set[str] = set()
+# 更宽容的匹配：优先匹配 ip:port，然后 ip sep port；如果没有端口则尝试行内推断最近的数字作为端口
+ip_colon_port = re.compile(r"(?P<ip>(?:\d{1,3}\.){3}\d{1,3})\s*[:#]\s*(?P<port>\d{1,5})")
+ip_space_comma_port = re.compile(r"(?P<ip>(?:\d{1,3}\.){3}\d{1,3})[\s,;]+(?P<port>\d{1,5})")
+ip_only = re.compile(r"(?P<ip>(?:\d{1,3}\.){3}\d{1,3})")
 
-    # 更宽容的匹配：优先匹配 ip:port，然后 ip sep port；如果没有端口则尝试行内推断最近的数字作为端口
-    ip_colon_port = re.compile(r"(?P<ip>(?:\d{1,3}\.){3}\d{1,3})\s*[:#]\s*(?P<port>\d{1,5})")
-    ip_space_comma_port = re.compile(r"(?P<ip>(?:\d{1,3}\.){3}\d{1,3})[\s,;]+(?P<port>\d{1,5})")
-    ip_only = re.compile(r"(?P<ip>(?:\d{1,3}\.){3}\d{1,3})")
+IP_ALIASES = {"ip地址", "ip address", "ip"}
+PORT_ALIASES = {"端口", "port"}
 
-    IP_ALIASES = {"ip地址", "ip address", "ip"}
-    PORT_ALIASES = {"端口", "port"}
+def is_valid_ip(ip: str) -> bool:
+    parts = ip.split('.')
+    if len(parts) != 4:
+        return False
+    try:
+        return all(0 <= int(p) <= 255 for p in parts)
+    except ValueError:
+        return False
 
-    def is_valid_ip(ip: str) -> bool:
-        parts = ip.split('.')
-        if len(parts) != 4:
-            return False
-        try:
-            return all(0 <= int(p) <= 255 for p in parts)
-        except ValueError:
-            return False
+def is_valid_port(p: str) -> bool:
+    try:
+        v = int(p)
+        return 1 <= v <= 65535
+    except Exception:
+        return False
 
-    def is_valid_port(p: str) -> bool:
-        try:
-            v = int(p)
-            return 1 <= v <= 65535
-        except Exception:
-            return False
-
-    def parse_line_add_unique(line: str, store: Set[str]):
-        # 尝试多种模式
-        m = ip_colon_port.search(line) or ip_space_comma_port.search(line)
-        ip = port = None
-        if m:
-            ip = m.group('ip')
-            port = m.group('port')
-        else:
-            m_ip = ip_only.search(line)
-            if m_ip:
-                ip = m_ip.group('ip')
-                # 尝试找到 ip 后最近的数字作为端口
-                rest = line[m_ip.end():]
-                m_num = re.search(r"\d{1,5}", rest)
-                if m_num:
-                    port = m_num.group(0)
-        if ip and port and is_valid_ip(ip) and is_valid_port(port):
-            store.add(f"{ip} {port}")
+# 单次扫描：找到行内第一个IP，并在同一次匹配中尝试其后的 冒号/井号 或 分隔符+端口
+endpoint_token = re.compile(
+    r"(?P<ip>(?P<o1>\d{1,3})\.(?P<o2>\d{1,3})\.(?P<o3>\d{1,3})\.(?P<o4>\d{1,3}))"
+    r"(?:\s*[:#]\s*(?P<cport>\d{1,5})|[\s,;]+(?P<sport>\d{1,5}))?"
+)
+trailing_number = re.compile(r"\d{1,5}")
+# 八位组查表 (含前导零写法，如 '07'、'007')，免去 split/int 分配；不在表中即为非法或非 ASCII 数字
+OCTET_VALUES = {str(v).zfill(width): v for v in range(256) for width in (1, 2, 3) if len(str(v)) <= width}
+
+def extract_endpoint_cascade(line: str) -> Optional[int]:
+    """原始的级联提取逻辑，作为单次扫描无法确定结果时的回退。"""
+    # 尝试多种模式
+    m = ip_colon_port.search(line) or ip_space_comma_port.search(line)
+    ip = port = None
+    if m:
+        ip = m.group('ip')
+        port = m.group('port')
+    else:
+        m_ip = ip_only.search(line)
+        if m_ip:
+            ip = m_ip.group('ip')
+            # 尝试找到 ip 后最近的数字作为端口
+            m_num = trailing_number.search(line, m_ip.end())
+            if m_num:
+                port = m_num.group(0)
+    if ip and port and is_valid_ip(ip) and is_valid_port(port):
+        return pack(ip, int(port))
+    return None
+
+def extract_endpoint(line: str) -> Optional[int]:
+    """
+    从一行文本中提取 IP+端口 并返回打包键，结果与级联逻辑完全一致：
+    行内第一个IP即是所有模式可能的最左起点，若其后紧跟 冒号+端口 即为最终结果；
+    紧跟 分隔符+端口 且整行不含 ':'/'#' (不可能存在冒号格式) 时同样可直接确定。
+    其余少见情况回退到级联逻辑。
+    """
+    m = endpoint_token.search(line)
+    if m is None:
+        return None
+    _, o1, o2, o3, o4, port, sport = m.groups()
+    if port is None:
+        port = sport
+        if port is None or ':' in line or '#' in line:
+            return extract_endpoint_cascade(line)
+    get = OCTET_VALUES.get
+    o1, o2, o3, o4 = get(o1), get(o2), get(o3), get(o4)
+    if o1 is None or o2 is None or o3 is None or o4 is None:
+        return extract_endpoint_cascade(line)
+    port_value = int(port)
+    if not 0 < port_value <= 65535:
+        return None
+    return (((o1 << 24) | (o2 << 16) | (o3 << 8) | o4) << 16) | port_value
+
+def parse_line_add_unique(line: str, store: EndpointSet):
+    key = extract_endpoint(line)
+    if key is not None:
+        store.add(key)
+
+def extract_file(file_path: Path, unique_ips: EndpointSet) -> None:
+    """从单个文件中提取IP和端口：CSV 优先按表头列解析，其余逐行扫描。"""
+    if file_path.suffix.lower() == '.csv':
+        with file_path.open('r', encoding='utf-8', errors='ignore') as f:
+            # 读取首行并尝试判断表头
+            sample = f.read(4096)
+            f.seek(0)
+            header_line = sample.splitlines()[0] if sample else ''
+            if not any(alias in header_line.lower() for alias in IP_ALIASES):
+                tqdm.write(f"[i] CSV '{file_path.name}' 表头不规范或未包含 IP 列，按逐行扫描。")
+                for line in f:
+                    parse_line_add_unique(line, unique_ips)
+                return
+
+            # 尝试用 DictReader 读取（兼容有表头的 CSV）
+            try:
+                f.seek(0)
+                sample2 = f.read(8192)
+                f.seek(0)
+                has_header = False
+                try:
+                    has_header = csv.Sniffer().has_header(sample2)
+                except Exception:
+                    has_header = True
+                if has_header:
+                    reader = csv.DictReader(f)
+                    ip_col = next((fld for fld in (reader.fieldnames or []) if fld and fld.lower().strip() in IP_ALIASES), None)
+                    port_col = next((fld for fld in (reader.fieldnames or []) if fld and fld.lower().strip() in PORT_ALIASES), None)
+                    if ip_col and port_col:
+                        for row in reader:
+                            raw_ip = (row.get(ip_col) or '').strip()
+                            raw_port = (row.get(port_col) or '').strip()
+                            # 兼容 ip:port 写在同一字段
+                            if raw_ip and ':' in raw_ip and not raw_port:
+                                m = ip_colon_port.search(raw_ip)
+                                if m:
+                                    raw_ip = m.group('ip')
+                                    raw_port = m.group('port')
+                            if raw_ip and raw_port and is_valid_ip(raw_ip) and is_valid_port(raw_port):
+                                unique_ips.add_endpoint(raw_ip, int(raw_port))
+                            else:
+                                # 若列识别失败，尝试逐行解析该 CSV 的行文本
+                                parse_line_add_unique(','.join(row.values()), unique_ips)
+                        return
+            except Exception:
+                f.seek(0)
+                for line in f:
+                    parse_line_add_unique(line, unique_ips)
+    else:
+        with file_path.open('r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                parse_line_add_unique(line, unique_ips)
+
+def scan_chunk(path: str, start: int, end: int) -> bytes:
+    """
+    [进程池工作函数] 逐行扫描文件中起始偏移落在 [start, end) 内的所有行。
+    分块边界按换行对齐：跨越 start 的那一行归前一个分块处理。返回打包键的字节串。
+    """
+    store = EndpointSet()
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            parse_line_add_unique(line.decode('utf-8', errors='ignore'), store)
+    return store.keys().tobytes()
+
+def extract_file_worker(path: str) -> bytes:
+    """[进程池工作函数] 整体处理一个文件 (用于需要识别表头的 CSV)。"""
+    store = EndpointSet()
+    file_path = Path(path)
+    try:
+        extract_file(file_path, store)
+    except Exception as e:
+        tqdm.write(f"[-] 处理文件 '{file_path.name}' 时出错: {e}")
+    return store.keys().tobytes()
+
+def plan_work_units(files: List[Path], chunk_size: int) -> List[Tuple[Path, int, int]]:
+    """把 .txt 文件按字节区间切分为多个分块；CSV 需要整体识别表头，作为单个单元 (区间记为 -1)。"""
+    units: List[Tuple[Path, int, int]] = []
+    for file_path in files:
+        if file_path.suffix.lower() == '.csv':
+            units.append((file_path, -1, -1))
+            continue
+        size = file_path.stat().st_size
+        for start in range(0, max(size, 1), chunk_size):
+            units.append((file_path, start, min(start + chunk_size, size)))
+    return units
+
+def process_files_parallel(files_to_process: List[Path], unique_ips: EndpointSet) -> None:
+    """
+    多进程提取：大文件按换行对齐切块，各进程返回部分结果后在主进程合并。
+    主流程在提取线程中调用本函数，此时进程内还有测速线程池与事件循环在运行，
+    因此工作进程以 spawn 方式启动，不 fork 多线程的父进程。
+    """
+    units = plan_work_units(files_to_process, IPCCC_CHUNK_MB * 1024 * 1024)
+    print(f"[*] 启用 {IPCCC_WORKERS} 个进程并行提取，共 {len(units)} 个分块。")
+    with ProcessPoolExecutor(max_workers=IPCCC_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {
+            (pool.submit(extract_file_worker, str(path)) if start < 0
+             else pool.submit(scan_chunk, str(path), start, end)): path
+            for path, start, end in units
+        }
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="提取进度", unit="块"):
+            try:
+                part = array('Q')
+                part.frombytes(fut.result())
+                unique_ips.update(part)
+            except Exception as e:
+                tqdm.write(f"[-] 处理文件 '{futures[fut].name}' 时出错: {e}")
+
+def process_files(files_to_process: List[Path], output_file: Path, unique_ips: Optional[EndpointSet] = None) -> None:
+    """[核心升级] 从指定的文件列表中提取IP和端口，智能处理多种格式。unique_ips 可传入流式输出的集合。"""
+    if unique_ips is None:
+        unique_ips = EndpointSet()
 
     print(f"\n[*] 开始从 {len(files_to_process)} 个文件中智能提取IP...")
-    for file_path in tqdm(files_to_process, desc="提取进度", unit="个文件"):
-        try:
-            if file_path.suffix.lower() == '.csv':
-                with file_path.open('r', encoding='utf-8', errors='ignore') as f:
-                    # 读取首行并尝试判断表头
-                    sample = f.read(4096)
-                    f.seek(0)
-                    header_line = sample.splitlines()[0] if sample else ''
-                    if not any(alias in header_line.lower() for alias in IP_ALIASES):
-                        tqdm.write(f"[i] CSV '{file_path.name}' 表头不规范或未包含 IP 列，按逐行扫描。")
-                        for line in f:
-                            parse_line_add_unique(line, unique_ips)
-                        continue
-
-                    # 尝试用 DictReader 读取（兼容有表头的 CSV）
-                    try:
-                        f.seek(0)
-                        sample2 = f.read(8192)
-                        f.seek(0)
-                        has_header = False
-                        try:
-                            has_header = csv.Sniffer().has_header(sample2)
-                        except Exception:
-                            has_header = True
-                        if has_header:
-                            reader = csv.DictReader(f)
-                            ip_col = next((fld for fld in (reader.fieldnames or []) if fld and fld.lower().strip() in IP_ALIASES), None)
-                            port_col = next((fld for fld in (reader.fieldnames or []) if fld and fld.lower().strip() in PORT_ALIASES), None)
-                            if ip_col and port_col:
-                                for row in reader:
-                                    raw_ip = (row.get(ip_col) or '').strip()
-                                    raw_port = (row.get(port_col) or '').strip()
-                                    # 兼容 ip:port 写在同一字段
-                                    if raw_ip and ':' in raw_ip and not raw_port:
-                                        m = ip_colon_port.search(raw_ip)
-                                        if m:
-                                            raw_ip = m.group('ip')
-                                            raw_port = m.group('port')
-                                    if raw_ip and raw_port and is_valid_ip(raw_ip) and is_valid_port(raw_port):
-                                        unique_ips.add(f"{raw_ip} {raw_port}")
-                                    else:
-                                        # 若列识别失败，尝试逐行解析该 CSV 的行文本
-                                        parse_line_add_unique(','.join(row.values()), unique_ips)
-                                continue
-                    except Exception:
-                        f.seek(0)
-                        for line in f:
-                            parse_line_add_unique(line, unique_ips)
-            else:
-                with file_path.open('r', encoding='utf-8', errors='ignore') as f:
-                    for line in f:
-                        parse_line_add_unique(line, unique_ips)
-        except Exception as e:
-            tqdm.write(f"[-] 处理文件 '{file_path.name}' 时出错: {e}")
+    total_size = sum(f.stat().st_size for f in files_to_process)
+    if IPCCC_WORKERS > 1 and total_size >= IPCCC_CHUNK_MB * 1024 * 1024:
+        process_files_parallel(files_to_process, unique_ips)
+    else:
+        for file_path in tqdm(files_to_process, desc="提取进度", unit="个文件"):
+            try:
+                extract_file(file_path, unique_ips)
+            except Exception as e:
+                tqdm.write(f"[-] 处理文件 '{file_path.name}' 时出错: {e}")
+
+    unique_ips = ip_history.filter_suppressed(unique_ips)
 
     if not unique_ips:
         print("\n[!] 在所选文件中未能提取到任何有效的 IP 地址和端口。")
         return
     
-    sorted_ips = sorted(list(unique_ips), key=lambda x: [int(part) for part in x.split(' ')[0].split('.')])
+    # 打包键的数值顺序即 IP 数值顺序，无需逐条拆分字符串排序
     try:
         with output_file.open('w', encoding='utf-8') as f_out:
-            for item in sorted_ips:
+            for item in unique_ips.lines():
                 f_out.write(item + '\n')
         print("\n" + "[SUCCESS]" * 5)
-        print(f"[+] 处理完成！共提取并保存了 {len(sorted_ips)} 条唯一的 IP 地址和端口记录。")
+        print(f"[+] 处理完成！共提取并保存了 {len(unique_ips)} 条唯一的 IP 地址和端口记录。")
         print(f"    结果已保存至: '{output_file}'")
         print("[SUCCESS]" * 5)
     except Exception as e:
         print(f"\n[-] [致命错误] 保存结果到文件 '{output_file}' 时发生严重错误: {e}")
         sys.exit(1)
 
-def main() -> None:
-    """程序主入口。"""
-    output_path = CURRENT_DIR / OUTPUT_FILENAME
+def choose_files() -> List[Path]:
+    """扫描源文件并确定本次要处理的文件：交互式终端中由用户选择，否则处理全部。"""
     all_files = find_source_files()
-
     if not all_files:
         print("\n[!] 当前目录未找到任何可供处理的 .txt 或 .csv 文件。")
-        output_path.touch()
-        print(f"[i] 已创建空的 '{output_path.name}' 文件。")
-        return
-
-    files_to_run = []
+        return []
     # [关键优化] 检测是否在交互式终端中运行
     if sys.stdin.isatty():
         # 手动执行，显示菜单
-        files_to_run = select_files_from_list(all_files)
-    else:
-        # 机器人调用，自动处理所有文件
-        print("[*] 在非交互模式下运行，将自动处理所有找到的源文件。")
-        files_to_run = all_files
+        return select_files_from_list(all_files)
+    # 机器人调用，自动处理所有文件
+    print("[*] 在非交互模式下运行，将自动处理所有找到的源文件。")
+    return all_files
+
+def main(sink: Optional[EndpointSet] = None, files: Optional[List[Path]] = None) -> None:
+    """
+    程序主入口。sink 为收集结果的集合，流水线模式下传入流式输出的集合。
+    files 为调用方已选定的源文件，None 时在此扫描并选择。
+    """
+    output_path = CURRENT_DIR / OUTPUT_FILENAME
+    files_to_run = choose_files() if files is None else files
 
     if files_to_run:
-        process_files(files_to_run, output_path)
+        process_files(files_to_run, output_path, sink)
     else:
         print("[i] 没有选择任何文件或未找到文件，操作结束。")
         output_path.touch()
         print(f"[i] 已创建空的 '{output_path.name}' 文件。")
 
+def iter_endpoints(maxsize: int = 0, files: Optional[List[Path]] = None) -> EndpointStream:
+    """
+    [库接口] 在当前进程内运行完整提取流程，从本地源文件中逐个产出新提取到的IP (打包整数键)。
+    冷却期内的IP不会产出；ip.txt 仍在结束时写出。maxsize 为内部队列容量，0 表示不限。
+    提取在后台线程中进行，交互式的文件选择应由调用方先用 choose_files() 完成再经 files 传入。
+    """
+    return EndpointStream(lambda sink: main(sink, files), ip_history.suppressed_keys(), maxsize)
+
 if __name__ == "__main__":
     main()
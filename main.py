@@ -5,6 +5,9 @@ IP处理主脚本 (智能检测最终版):
 - [升级] 自动检测API和Gist配置，如果两者都存在则让用户交互式选择。
 - 并行执行新旧IP的测速任务以缩短总耗时。
 - [重构] 模式一和模式二现在都由独立的、更智能的Python脚本处理。
+- [流水线] 提取模块边解析边产出候选IP，经有界队列分批后立即测速，提取与测速同时进行。
+- [重构] 提取模块以库的形式在同一进程内调用，候选集合全程保留在内存中。
+- [统一] 新旧IP先合并为一个候选集合并标记来源 (新/旧/两者)，每个IP只测速一次。
 """
 import subprocess
 import sys
@@ -16,12 +19,18 @@ import re
 import time
 import shutil
 import os
+import hashlib
 import json
+import sqlite3
+import statistics
+import threading
+import queue
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Iterable, Iterator, Collection, Callable
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from concurrent.futures import wait, FIRST_COMPLETED
 import tempfile
 import math
 import uuid
@@ -30,6 +39,16 @@ import uuid
 from dotenv import load_dotenv
 import requests
 
+import cluster
+import cmip_downloader
+import geoindex
+import ip_history
+import ipccc
+import native_iptest
+import run_journal
+import scheduler
+from endpoints import EndpointSet, EndpointStream, ExtractionError, format_key, pack, parse_line
+
 # ==============================================================================
 # --- 配置加载部分 ---
 # ==============================================================================
@@ -45,6 +64,12 @@ IPTEST_SPEEDTEST = os.getenv("IPTEST_SPEEDTEST", "3")
 IPTEST_SPEEDLIMIT = os.getenv("IPTEST_SPEEDLIMIT", "6")
 IPTEST_DELAY = os.getenv("IPTEST_DELAY", "260")
 
+# 测速引擎：exe 调用 iptest.exe；native 使用内置 asyncio 测速器 (适用于 Linux 等无法高效运行 .exe 的环境)；
+# cluster 把批次分发给其他主机上的 worker (python cluster.py worker) 测速
+IPTEST_ENGINE = os.getenv("IPTEST_ENGINE", "exe").strip().lower()
+NATIVE_HTTP_TIMEOUT = float(os.getenv("NATIVE_HTTP_TIMEOUT", "5"))        # native 引擎 TLS/HTTP 请求超时(s)
+NATIVE_DOWNLOAD_SECONDS = float(os.getenv("NATIVE_DOWNLOAD_SECONDS", "5")) # native 引擎单个 IP 下载测速时长(s)
+
 # 并发测速与稳定策略（可配置，灵感来源 CloudflareBestIP）
 TEST_CONCURRENCY = int(os.getenv("TEST_CONCURRENCY", "2"))           # 同时运行的 iptest 实例数
 TEST_BATCH_SIZE = int(os.getenv("TEST_BATCH_SIZE", "200"))           # 将输入 IP 列表分批，每批大小
@@ -52,6 +77,68 @@ TEST_RETRY = int(os.getenv("TEST_RETRY", "2"))                       # 每个批
 TEST_COOLDOWN = float(os.getenv("TEST_COOLDOWN", "0.5"))            # 批次失败后的基础等待(s)，会指数退避
 TEST_START_DELAY = float(os.getenv("TEST_START_DELAY", "0.1"))       # 启动每个并发任务前的微小延迟，避免突发性峰值
 TEST_MERGE_SKIP_HEADER = True                                           # 合并 CSV 时跳过后续文件头部
+# 批次结果在完成时即解析入内存，合并后的 ip_test_result.csv 只作为可选的留档文件
+TEST_WRITE_MERGED_CSV = os.getenv("TEST_WRITE_MERGED_CSV", "0").strip().lower() in ("1", "true", "yes")
+
+# 自适应并发 (AIMD)：以 TEST_CONCURRENCY 为初值，按批次耗时、失败/重试与测得速度在上下限间调整，调整记录写入 run.log
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "1").strip().lower() in ("1", "true", "yes")
+TEST_CONCURRENCY_MIN = int(os.getenv("TEST_CONCURRENCY_MIN", "1"))
+TEST_CONCURRENCY_MAX = int(os.getenv("TEST_CONCURRENCY_MAX", "8"))
+ADAPTIVE_SLOWDOWN = float(os.getenv("ADAPTIVE_SLOWDOWN", "1.5"))     # 批次耗时变长/速度下降超过该倍数即视为拥塞
+
+# 批次时限与落后批次处理：超过硬性时限，或已运行时间超过 已完成批次中位耗时 × STRAGGLER_FACTOR 的批次会被终止，
+# 保留已写出的部分结果，其余IP拆成 STRAGGLER_SPLIT 个子批次重新排队 (最多拆分 STRAGGLER_MAX_DEPTH 层，
+# 达到该层数的子批次不再按中位耗时终止，只受硬性时限约束)
+TEST_BATCH_TIMEOUT = float(os.getenv("TEST_BATCH_TIMEOUT", "900"))     # 单批次硬性时限(s)，0 为不限
+STRAGGLER_FACTOR = float(os.getenv("STRAGGLER_FACTOR", "3"))            # 0 为关闭落后批次检测
+STRAGGLER_MIN_SAMPLES = int(os.getenv("STRAGGLER_MIN_SAMPLES", "3"))    # 至少完成多少个批次后才开始判断
+STRAGGLER_SPLIT = int(os.getenv("STRAGGLER_SPLIT", "4"))
+STRAGGLER_MAX_DEPTH = int(os.getenv("STRAGGLER_MAX_DEPTH", "2"))
+
+# 提前结束：有效结果达到 TEST_QUOTA 个即取消剩余批次 (0 为关闭)。
+# 指定国家/端口列表后，列表中每个国家 (与每个端口的组合) 都需达到该数量，其余结果不计入
+TEST_QUOTA = int(os.getenv("TEST_QUOTA", "0"))
+TEST_QUOTA_COUNTRIES = os.getenv("TEST_QUOTA_COUNTRIES", "")
+TEST_QUOTA_PORTS = os.getenv("TEST_QUOTA_PORTS", "")
+
+# 全局带宽预算：所有测速实例共享的下载槽位数与平均带宽上限 (MB/s)，均为 0 时不限制
+DOWNLOAD_SLOTS = int(os.getenv("DOWNLOAD_SLOTS", "0"))
+BANDWIDTH_LIMIT_MBPS = float(os.getenv("BANDWIDTH_LIMIT_MBPS", "0"))
+BANDWIDTH_BUDGET = (scheduler.BandwidthBudget(DOWNLOAD_SLOTS, BANDWIDTH_LIMIT_MBPS)
+                    if DOWNLOAD_SLOTS > 0 or BANDWIDTH_LIMIT_MBPS > 0 else None)
+
+# 分布式测速 (IPTEST_ENGINE=cluster)：coordinator 监听地址、worker 共享口令，以及判定 worker 失联的租约时长(s)
+CLUSTER_HOST = os.getenv("CLUSTER_HOST", "0.0.0.0")
+CLUSTER_PORT = int(os.getenv("CLUSTER_PORT", "8787"))
+CLUSTER_TOKEN = os.getenv("CLUSTER_TOKEN", "")
+CLUSTER_LEASE_TIMEOUT = float(os.getenv("CLUSTER_LEASE_TIMEOUT", "60"))
+
+# 两级漏斗：完整测速前先做高并发 TCP 握手预筛，只让存活且延迟达标的 IP 进入下载测速
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+PREFILTER_CONCURRENCY = int(os.getenv("PREFILTER_CONCURRENCY", "1000"))   # 同时进行的握手探测数
+PREFILTER_RTT_FACTOR = float(os.getenv("PREFILTER_RTT_FACTOR", "1.5"))    # 握手耗时上限 = IPTEST_DELAY × 该系数
+PREFILTER_DEADLINE = float(os.getenv("PREFILTER_DEADLINE", "120"))       # 预筛阶段总时限(s)，超时未探测的IP保留
+
+# 测速历史库：TTL 内测速成功过的IP直接复用缓存结果，设为 0 则每次全部重测
+HISTORY_TTL_HOURS = float(os.getenv("HISTORY_TTL_HOURS", "6"))
+# 按历史质量排序：历史上速度快、延迟低、所在网段/端口成功率高的IP优先测速；关闭后按IP数值顺序
+PRIORITY_ORDER = os.getenv("PRIORITY_ORDER", "1").strip().lower() in ("1", "true", "yes")
+# 分组抽样：同一 /24 网段 + 端口的新IP先测 SAMPLE_PER_GROUP 个代表，代表通过才测其余成员 (旧IP不参与抽样)
+SAMPLING_ENABLED = os.getenv("SAMPLING_ENABLED", "0").strip().lower() in ("1", "true", "yes")
+SAMPLE_PER_GROUP = int(os.getenv("SAMPLE_PER_GROUP", "2"))
+# 离线国家过滤：按本地 CIDR->国家 CSV 在测速前剔除不在允许国家内的IP (任一项为空即关闭)
+GEO_DB_PATH = os.getenv("GEO_DB_PATH", "")
+GEO_ALLOWED_COUNTRIES = os.getenv("GEO_ALLOWED_COUNTRIES", "")
+# 断点续测：已完成的批次结果记录在 run_journal/ 下，进程被终止后以相同输入重新运行时只测未完成的IP
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+JOURNAL_MAX_AGE_HOURS = float(os.getenv("JOURNAL_MAX_AGE_HOURS", "12"))   # 超过该时长的日志不再续用
+GEO_KEEP_UNKNOWN = os.getenv("GEO_KEEP_UNKNOWN", "1").strip().lower() in ("1", "true", "yes")   # 保留数据库未收录的IP
+
+# 提取/测速流水线：提取模块边解析边产出，批次凑满即开始测速；关闭后先完整提取再测速
+PIPELINE_ENABLED = os.getenv("PIPELINE_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "100000"))   # 候选队列容量，满时提取线程被阻塞 (背压)
+PIPELINE_CHUNK_SIZE = int(os.getenv("PIPELINE_CHUNK_SIZE", "5000"))     # 每攒够多少个候选做一次历史复用与预筛
+PIPELINE_LINGER = float(os.getenv("PIPELINE_LINGER", "2"))              # 队列空闲超过该秒数时不再等待凑满，直接放行
 
 # Telegram Bot 配置
 TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN")
@@ -67,13 +154,10 @@ GIST_FILENAME = os.getenv("GIST_FILENAME", "ip_list.txt")
 # --- 脚本内部路径与常量定义 ---
 # ==============================================================================
 BASE_DIR = Path(__file__).parent.resolve()
-IPCCC_PY = BASE_DIR / "ipccc.py"
-# [修改] 指向新的Python脚本
-CMIP_PY = BASE_DIR / "cmip_downloader.py" 
 IPTEST_EXE = BASE_DIR / "iptest.exe"
 IP_TXT = BASE_DIR / "ip.txt"
-NEW_IP_TEST_RESULT_CSV = BASE_DIR / "new_ip_test_result.csv"
-OLD_IP_TEST_RESULT_CSV = BASE_DIR / "old_ip_test_result.csv"
+IP_TEST_RESULT_CSV = BASE_DIR / "ip_test_result.csv"
+JOURNAL_DIR = BASE_DIR / "run_journal"
 API_TEMP_TXT = BASE_DIR / "api_temp.txt"
 FINAL_IP_LIST_TXT = BASE_DIR / "final_ip_list.txt"
 
@@ -229,133 +313,447 @@ def choose_mode() -> str:
         if mode in ("1", "2"): return mode
         print("输入无效，请重新输入。")
 
-def run_script(mode: str) -> None:
+def open_extractor(mode: str, maxsize: int = 0) -> EndpointStream:
     """
-    [重构] 模式二现在调用新的Python脚本 cmip_downloader.py。
+    在当前进程内启动提取流程：模式一 ipccc，模式二 cmip_downloader。
+    模式一的源文件在主线程中选定 (交互式终端中会提示输入)，之后提取才转入后台线程。
     """
-    script_path = IPCCC_PY if mode == "1" else CMIP_PY
-    script_name = script_path.name
-    
-    print(f"\n--- [步骤1: 生成IP源文件] 正在运行 {script_name} ---")
-    try:
-        cmd = [sys.executable, str(script_path)]
-        print(f"▶️ 正在执行命令: {' '.join(cmd)}")
-        subprocess.run(cmd, check=True)
-        
-        if not IP_TXT.exists():
-             print(f"⚠️ 警告: {script_name} 运行后未生成 '{IP_TXT.name}' 文件。可能是因为没有选择文件或提取失败。")
-             IP_TXT.touch() # 创建一个空文件以防后续步骤出错
-        else:
-             print(f"✅ {script_name} 运行成功。")
+    if mode == "1":
+        return ipccc.iter_endpoints(maxsize, ipccc.choose_files())
+    return cmip_downloader.iter_endpoints(maxsize)
 
-    except FileNotFoundError as e: 
-        print(f"❌ 错误: 找不到所需的文件或程序: {e}")
-        sys.exit(1)
-    except subprocess.CalledProcessError as e:
-        print(f"❌ {script_name} 脚本执行失败，返回码: {e.returncode}")
-        if hasattr(e, 'stderr') and e.stderr: 
-            print(f"   错误输出:\n{e.stderr}")
+def extract_candidates(mode: str) -> EndpointSet:
+    """
+    [重构] 直接在进程内调用提取模块并把结果保留在内存中，不再启动子进程、也不再回读 ip.txt。
+    """
+    module_name = "ipccc" if mode == "1" else "cmip_downloader"
+    print(f"\n--- [步骤1: 生成IP源] 正在运行 {module_name} ---")
+    try:
+        candidates = EndpointSet(open_extractor(mode))
+    except ExtractionError as e:
+        print(f"❌ {module_name} 执行失败: {e}")
         sys.exit(1)
+    if not candidates:
+        print(f"⚠️ 警告: {module_name} 未提取到任何IP。可能是因为没有选择文件或提取失败。")
+    else:
+        print(f"✅ {module_name} 运行成功，共 {len(candidates)} 个候选IP。")
+    return candidates
 
-def run_iptest(input_file: Path, output_csv: Path) -> None:
-    if not input_file.exists() or input_file.stat().st_size == 0:
-        print(f"ℹ️ 跳过对 '{input_file.name}' 的测速，因为文件不存在或为空。")
-        return
-    print(f"--- [测速] 正在对 '{input_file.name}' 进行测速 ---")
-
-    # 将输入拆分为多个批次，每个批次为一个临时文件，随后并发运行 iptest
-    total_lines = 0
-    with input_file.open('r', encoding='utf-8', errors='ignore') as rf:
-        for _ in rf:
-            total_lines += 1
-    if total_lines == 0:
-        print(f"ℹ️ '{input_file.name}' 中无有效数据，跳过测速")
-        return
+def run_native_batch(in_path: Path, out_path: Path, abort: Optional[threading.Event] = None) -> None:
+    """使用内置 asyncio 测速器处理一个批次，参数与 iptest.exe 命令行保持一致。"""
+    native_iptest.run_batch_file(
+        in_path, out_path, url=SPEED_TEST_URL, max_conn=int(IPTEST_MAX),
+        speedtest=int(IPTEST_SPEEDTEST), speedlimit=float(IPTEST_SPEEDLIMIT),
+        delay_ms=int(IPTEST_DELAY), http_timeout=NATIVE_HTTP_TIMEOUT,
+        download_seconds=NATIVE_DOWNLOAD_SECONDS, budget=BANDWIDTH_BUDGET, abort=abort,
+    )
+
+def warn_inert_bandwidth_budget() -> None:
+    """带宽预算只在部分引擎下生效，配置了却不起作用时给出提示，而不是静默忽略。"""
+    if BANDWIDTH_LIMIT_MBPS > 0 and IPTEST_ENGINE != 'native':
+        # 平均带宽按实际下载字节扣减额度，只有内置测速器能提供字节数
+        print(f"⚠️ BANDWIDTH_LIMIT_MBPS 只对 native 引擎生效，当前引擎 ({IPTEST_ENGINE}) 下不会限制平均带宽。")
+    if DOWNLOAD_SLOTS > 0 and IPTEST_ENGINE == 'cluster':
+        print("⚠️ 分布式测速时 DOWNLOAD_SLOTS 不作用于各 worker，请通过 worker 的 --slots 参数控制并发。")
+
+_coordinator: Optional[cluster.Coordinator] = None
+_coordinator_lock = threading.Lock()
 
-    batches = []
-    current = []
-    with input_file.open('r', encoding='utf-8', errors='ignore') as rf:
-        for line in rf:
-            if line.strip():
-                current.append(line.strip())
-            if len(current) >= TEST_BATCH_SIZE:
-                batches.append(current)
-                current = []
-        if current:
-            batches.append(current)
-
-    temp_dir = Path(tempfile.mkdtemp(prefix='iptest_'))
+def get_coordinator() -> cluster.Coordinator:
+    """首次使用时启动分布式测速的 coordinator，之后各测速阶段共用。"""
+    global _coordinator
+    with _coordinator_lock:
+        if _coordinator is None:
+            params = {"url": SPEED_TEST_URL, "max": IPTEST_MAX, "speedtest": IPTEST_SPEEDTEST,
+                      "speedlimit": IPTEST_SPEEDLIMIT, "delay": IPTEST_DELAY,
+                      "http_timeout": NATIVE_HTTP_TIMEOUT, "download_seconds": NATIVE_DOWNLOAD_SECONDS}
+            _coordinator = cluster.Coordinator(CLUSTER_HOST, CLUSTER_PORT, CLUSTER_TOKEN, CLUSTER_LEASE_TIMEOUT, params)
+            _coordinator.start()
+            if not CLUSTER_TOKEN:
+                print("⚠️ 未设置 CLUSTER_TOKEN，任何能访问该端口的主机都可以领取批次、提交结果。")
+            print(f"🛰️ 分布式测速已启动，等待 worker 连接: {_coordinator.address}")
+        return _coordinator
+
+def run_iptest_process(cmd: List[str], abort: threading.Event) -> None:
+    """运行一个 iptest.exe 实例；abort 被设置时终止进程 (先 terminate，5 秒后仍未退出则 kill)。"""
+    proc = subprocess.Popen(cmd)
+    while True:
+        try:
+            returncode = proc.wait(timeout=0.5)
+            break
+        except subprocess.TimeoutExpired:
+            if abort.is_set():
+                proc.terminate()
+                try:
+                    proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+                return
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def iter_batches(lines: Iterable[str], size: int) -> Iterator[List[str]]:
+    """惰性切分批次：逐行读取，凑满 size 行即产出一批，不预先统计行数，也不缓存全部批次。"""
+    batch: List[str] = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            batch.append(line)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def run_batches(batches: Iterable[List[str]], output_csv: Path,
+                quota: Optional[scheduler.QuotaTracker] = None,
+                journal: Optional[run_journal.RunJournal] = None) -> Tuple[EndpointSet, List[Dict[str, Any]]]:
+    """
+    并发执行批次，每个批次完成时即解析其结果 CSV。batches 可以是惰性生成器，只在有空位时才被继续读取。
+    启用自适应并发时，同时运行的批次数由 AIMD 控制器根据已完成批次的表现动态调整。
+    运行超过 TEST_BATCH_TIMEOUT，或远超已完成批次中位耗时的落后批次会被终止：
+    保留其已写出的部分结果，未出结果的IP拆成更小的子批次重新排队。
+    传入 quota 时，每个批次结果落地后计入配额，达标后不再派发新批次并终止仍在运行的批次。
+    传入 journal 时，批次文件写在日志目录中并逐个登记；续测时跳过日志中已完成的IP，并载入之前的结果。
+    TEST_WRITE_MERGED_CSV 开启时另把全部批次输出合并写入 output_csv 留档。
+    返回 (确实跑完测速的全部IP, 全部结果记录)。
+    """
+    if ADAPTIVE_CONCURRENCY:
+        controller = scheduler.AimdController(TEST_CONCURRENCY, TEST_CONCURRENCY_MIN, TEST_CONCURRENCY_MAX, ADAPTIVE_SLOWDOWN)
+    else:
+        controller = None
+    temp_dir = journal.work_dir if journal else Path(tempfile.mkdtemp(prefix='iptest_'))
+    finished_ok = False
     try:
         batch_outputs = []
-        def run_batch(batch_idx: int, lines: list, attempt: int = 1):
+        records: List[Dict[str, Any]] = []
+        tested = EndpointSet()
+        if journal and journal.resumed:
+            print(f"⏯️ 从上次中断处继续：复用 {len(journal.outputs)} 个已完成批次 ({len(journal.completed)} 个IP) 的结果")
+            batch_outputs.extend(journal.outputs)
+            tested.update(journal.completed.keys())
+            for path in journal.outputs:
+                rows = parse_batch_csv(path)
+                records.extend(rows)
+                count_result_rows(quota, rows)
+            completed = journal.completed
+            batches = iter_batches((line for lines in batches for line in lines if parse_line(line) not in completed),
+                                   TEST_BATCH_SIZE)
+        # 正常完成批次的耗时，用于判断落后批次。批次内各IP并发测速，耗时主要取决于超时与下载阶段，
+        # 与批次行数关系不大，因此按整批耗时比较，尾部的小批次与拆分出的子批次不会被过早判为落后
+        batch_times: List[float] = []
+        def run_batch(batch_idx: str, lines: list, epoch: int, abort: threading.Event,
+                      on_start: Callable[[], None], attempt: int = 1):
             in_path = temp_dir / f'batch_{batch_idx}.txt'
             out_path = temp_dir / f'batch_{batch_idx}.csv'
             in_path.write_text('\n'.join(lines), encoding='utf-8')
             time.sleep(TEST_START_DELAY * (attempt - 1))
             cmd = [str(IPTEST_EXE), f"-file={in_path}", f"-outfile={out_path}", f"-max={IPTEST_MAX}", f"-speedtest={IPTEST_SPEEDTEST}", f"-speedlimit={IPTEST_SPEEDLIMIT}", f"-delay={IPTEST_DELAY}", f"-url={SPEED_TEST_URL}"]
             try:
-                subprocess.run(cmd, check=True)
+                if IPTEST_ENGINE == 'native':
+                    on_start()
+                    run_native_batch(in_path, out_path, abort)
+                elif IPTEST_ENGINE == 'cluster':
+                    get_coordinator().run(lines, out_path, abort, on_start)
+                elif BANDWIDTH_BUDGET is not None and int(IPTEST_SPEEDTEST) > 0:
+                    # iptest.exe 的延迟与下载阶段无法拆分，整个实例按其 -speedtest 下载线程数占用槽位
+                    held = BANDWIDTH_BUDGET.acquire(int(IPTEST_SPEEDTEST))
+                    try:
+                        on_start()
+                        run_iptest_process(cmd, abort)
+                    finally:
+                        BANDWIDTH_BUDGET.release(held)
+                else:
+                    on_start()
+                    run_iptest_process(cmd, abort)
                 return out_path
             except FileNotFoundError:
-                print(f"❌ 错误: 未找到 'iptest.exe'。请确保它位于脚本同目录下。")
+                print(f"❌ 错误: 未找到 'iptest.exe'。请确保它位于脚本同目录下，或设置 IPTEST_ENGINE=native。")
                 raise
-            except subprocess.CalledProcessError as e:
-                if attempt <= TEST_RETRY:
+            except (subprocess.CalledProcessError, OSError, cluster.BatchFailed) as e:
+                if controller:
+                    controller.on_failure(epoch, f"批次 {batch_idx} 第 {attempt} 次尝试失败: {e}")
+                if attempt <= TEST_RETRY and not abort.is_set():
                     backoff = TEST_COOLDOWN * (2 ** (attempt - 1))
                     print(f"❌ 批次 {batch_idx} 第 {attempt} 次尝试失败，等待 {backoff}s 后重试: {e}")
                     time.sleep(backoff)
-                    return run_batch(batch_idx, lines, attempt + 1)
+                    return run_batch(batch_idx, lines, epoch, abort, on_start, attempt + 1)
                 else:
                     print(f"❌ 批次 {batch_idx} 达到最大重试次数，失败: {e}")
                     raise
 
-        with ThreadPoolExecutor(max_workers=max(1, TEST_CONCURRENCY)) as ex:
-            futures = {ex.submit(run_batch, idx + 1, b): idx + 1 for idx, b in enumerate(batches)}
-            for fut in as_completed(futures):
+        def timed_batch(job: Dict[str, Any]):
+            # 批次真正开始测速时才计时：分布式模式下为被 worker 领取时，带宽预算下为 iptest.exe 取得下载槽位后；
+            # 之前在 coordinator 或槽位上排队的时间不受单批次时限与落后批次检测约束，也不计入中位耗时
+            job["started"] = None
+            on_start = lambda: job.update(started=time.time())
+            out_path = run_batch(job["idx"], job["lines"], job["epoch"], job["abort"], on_start)
+            started = job["started"]
+            return out_path, time.time() - started if started is not None else 0.0
+
+        def requeue_unfinished(job: Dict[str, Any], out_path: Path, rows: List[Dict[str, Any]]) -> None:
+            """落后批次被终止后：部分结果照常合并，未出结果的IP拆成子批次重新排队 (配额已达标时不再排队)。"""
+            finished = rows_endpoints(rows)
+            if finished:
+                batch_outputs.append(out_path)
+                records.extend(rows)
+                tested.update(finished.keys())
+                if journal:
+                    journal.record(out_path, finished.keys())
+            if stopping:
+                return
+            remaining = [line for line in job["lines"] if parse_line(line) not in finished]
+            if not remaining:
+                return
+            if job["depth"] >= STRAGGLER_MAX_DEPTH:
+                message = (f"批次 {job['idx']} 已拆分 {job['depth']} 次仍超时，其中 {len(remaining)} 个IP本次未测速"
+                           f" (不计入结果、负缓存与断点日志，下次运行会重新测速)")
+                print(f"⚠️ {message}")
+                logging.getLogger(__name__).warning(message)
+                return
+            size = math.ceil(len(remaining) / max(1, STRAGGLER_SPLIT))
+            for n, i in enumerate(range(0, len(remaining), size)):
+                retry_queue.append(new_job(f"{job['idx']}.{n + 1}", remaining[i:i + size], job["depth"] + 1))
+            print(f"🔀 批次 {job['idx']} 保留 {len(finished)} 条已完成结果，其余 {len(remaining)} 个IP拆分为子批次重新测速")
+
+        def collect(done) -> None:
+            for fut in done:
+                job = futures.pop(fut)
                 try:
-                    res = fut.result()
-                    batch_outputs.append(res)
+                    out_path, seconds = fut.result()
+                    rows = parse_batch_csv(out_path)
+                    count_result_rows(quota, rows)
+                    if job["abort"].is_set():
+                        requeue_unfinished(job, out_path, rows)
+                        continue
+                    batch_outputs.append(out_path)
+                    records.extend(rows)
+                    keys = [key for key in map(parse_line, job["lines"]) if key is not None]
+                    tested.update(keys)
+                    if journal:
+                        journal.record(out_path, keys)
+                    batch_times.append(seconds)
+                    if controller:
+                        controller.record(job["epoch"], seconds, len(job["lines"]), rows_mean_speed(rows))
                 except Exception as e:
                     print(f"❌ 某个批次执行失败: {e}")
 
-        # 合并批次输出
-        with output_csv.open('w', encoding='utf-8') as outf:
-            first = True
-            for p in batch_outputs:
-                if not p or not Path(p).exists():
+        def stop_for_quota() -> None:
+            """配额达标：清空待派发的批次，通知仍在运行的批次提前结束 (已测出的结果会保留)。"""
+            print(f"🎯 已达到目标数量 ({quota.summary()})，取消剩余批次并结束正在运行的测速")
+            retry_queue.clear()
+            for job in futures.values():
+                job["abort"].set()
+
+        def check_stragglers() -> None:
+            """
+            终止超过硬性时限、或耗时超过 已完成批次中位耗时 × STRAGGLER_FACTOR 的批次。
+            已拆分到 STRAGGLER_MAX_DEPTH 层的子批次无法再拆分，只按硬性时限终止，以免其中的IP被直接放弃。
+            """
+            now = time.time()
+            median_time = statistics.median(batch_times) if len(batch_times) >= STRAGGLER_MIN_SAMPLES else None
+            for job in futures.values():
+                if job["started"] is None or job["abort"].is_set():
+                    continue
+                elapsed = now - job["started"]
+                if TEST_BATCH_TIMEOUT > 0 and elapsed > TEST_BATCH_TIMEOUT:
+                    reason = f"超过单批次时限 {TEST_BATCH_TIMEOUT:g}s"
+                elif (STRAGGLER_FACTOR > 0 and median_time is not None and job["depth"] < STRAGGLER_MAX_DEPTH
+                      and elapsed > median_time * STRAGGLER_FACTOR):
+                    reason = f"超过中位耗时的 {STRAGGLER_FACTOR:g} 倍"
+                else:
                     continue
-                with p.open('r', encoding='utf-8', errors='ignore') as bf:
-                    for i, line in enumerate(bf):
-                        if i == 0 and not first and TEST_MERGE_SKIP_HEADER:
-                            continue
-                        outf.write(line)
-                first = False
-
-        print(f"✅ 测速完成，结果已保存到 '{output_csv.name}'。")
+                print(f"⏱️ 批次 {job['idx']} 已运行 {elapsed:.0f}s，{reason}，正在终止")
+                job["abort"].set()
+
+        def new_job(idx: str, lines: List[str], depth: int = 0) -> Dict[str, Any]:
+            return {"idx": idx, "lines": lines, "depth": depth, "epoch": 0,
+                    "abort": threading.Event(), "started": None}
+
+        if controller:
+            workers = controller.maximum
+            print(f"🎚️ 自适应并发已启用: 初始 {controller.limit}，范围 [{controller.minimum}, {controller.maximum}]")
+        else:
+            workers = max(1, TEST_CONCURRENCY)
+        futures: Dict[Any, Dict[str, Any]] = {}
+        retry_queue: deque = deque()
+        exhausted = False
+        stopping = False
+        submitted = 0
+        if quota is not None and quota.met:
+            print(f"🎯 复用的历史结果已满足目标数量 ({quota.summary()})，无需测速")
+            exhausted = stopping = True
+        # 批次生成器 (流水线中会等待提取线程放行候选、做TCP预筛) 在后台线程中运行，
+        # 调度循环只取已就绪的批次，生成器阻塞期间照常收集结果、检查配额与落后批次
+        feed = None if exhausted else scheduler.BatchFeed(batches)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            try:
+                while True:
+                    # 固定并发时预留一倍的排队批次；自适应时在途批次数即为当前并发上限
+                    while len(futures) < (controller.limit if controller else workers * 2):
+                        if retry_queue:
+                            job = retry_queue.popleft()
+                        elif not exhausted:
+                            try:
+                                # 没有在途批次时最多等待 1s，否则只取已就绪的批次
+                                lines = feed.get(0 if futures else 1.0)
+                            except queue.Empty:
+                                break
+                            if lines is None:
+                                exhausted = True
+                                continue
+                            submitted += 1
+                            job = new_job(str(submitted), lines)
+                        else:
+                            break
+                        job["epoch"] = controller.epoch if controller else 0
+                        futures[ex.submit(timed_batch, job)] = job
+                    if futures:
+                        done, _ = wait(futures, timeout=1.0, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    elif exhausted:
+                        break
+                    if quota is not None and not stopping and quota.met:
+                        exhausted = stopping = True
+                        feed.stop()
+                        stop_for_quota()
+                    check_stragglers()
+                if feed:
+                    # 等待批次生成线程退出，之后调用方 (如流水线收尾时取走剩余候选) 才能安全使用其数据源
+                    feed.close()
+            except BaseException:
+                # 被终止 (SIGTERM/Ctrl+C) 或出错时通知运行中的批次尽快结束，线程池不必等待整批跑完
+                if feed:
+                    feed.stop()
+                for job in futures.values():
+                    job["abort"].set()
+                raise
+        if not submitted and not batch_outputs:
+            finished_ok = True
+            print("ℹ️ 没有需要测速的有效数据，跳过测速")
+            return tested, records
+
+        if TEST_WRITE_MERGED_CSV:
+            merge_csv(batch_outputs, output_csv)
+            print(f"✅ 测速完成，共 {len(records)} 条结果，已另存到 '{output_csv.name}'。")
+        else:
+            print(f"✅ 测速完成，共 {len(records)} 条结果。")
+        finished_ok = True
+        return tested, records
     finally:
-        try:
-            shutil.rmtree(temp_dir)
-        except Exception:
-            pass
+        # 使用断点日志时只在正常结束后删除，被终止时保留已完成的批次供下次续测
+        if journal is None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        elif finished_ok:
+            journal.finish()
+
+def merge_csv(parts: Iterable[Path], output_csv: Path, append: bool = False) -> None:
+    """把多个测速结果 CSV 合并为 output_csv；append 为真时追加到已有文件之后。"""
+    first = not (append and output_csv.exists())
+    with output_csv.open('a' if append else 'w', encoding='utf-8') as outf:
+        for p in parts:
+            if not p or not Path(p).exists():
+                continue
+            with p.open('r', encoding='utf-8', errors='ignore') as bf:
+                for i, line in enumerate(bf):
+                    if i == 0 and not first and TEST_MERGE_SKIP_HEADER:
+                        continue
+                    outf.write(line)
+            first = False
+
+def parse_metric(text: Optional[str]) -> Optional[float]:
+    """从 '123 ms'、'12.34' 之类的字段中取出数值。"""
+    match = re.search(r"\d+(?:\.\d+)?", text or "")
+    return float(match.group(0)) if match else None
+
+HEADER_ALIASES = {
+    "ip": ["IP地址", "IP Address"], "port": ["端口", "Port"], "code": ["国际代码", "Country Code", "Code"],
+    "latency": ["网络延迟", "平均延迟", "Latency"], "speed": ["下载速度", "下载速度(MB/s)", "下载速度MB/s", "Download Speed"],
+}
+
+def resolve_columns(header: List[str]) -> Dict[str, Optional[int]]:
+    """按 HEADER_ALIASES 把表头解析为各字段的列号 (每个文件只解析一次)，缺失的字段为 None。"""
+    names = [name.strip() for name in header]
+    return {field: next((names.index(alias) for alias in aliases if alias in names), None)
+            for field, aliases in HEADER_ALIASES.items()}
 
-def process_ip_csv(input_csv: Path) -> List[str]:
-    if not input_csv.exists(): return []
-    print(f"--- [解析] 正在解析测速结果 '{input_csv.name}' ---")
-    result_lines: List[str] = []
-    HEADER_ALIASES = {"ip": ["IP地址", "IP Address"], "port": ["端口", "Port"], "code": ["国际代码", "Country Code", "Code"]}
+def parse_batch_csv(batch_csv: Path) -> List[Dict[str, Any]]:
+    """
+    解析单个批次的结果 CSV 为记录 (ip/port/code/latency_ms/speed)，表头别名只在读到表头时解析一次。
+    缺少 IP 或端口的行被跳过，没有国际代码的行 code 为空串；文件不存在或损坏时返回已读到的部分。
+    """
+    records: List[Dict[str, Any]] = []
     try:
-        with input_csv.open("r", encoding="utf-8-sig", errors='ignore') as f:
-            reader = csv.DictReader(f)
+        with batch_csv.open("r", encoding="utf-8-sig", errors='ignore', newline='') as f:
+            reader = csv.reader(f)
+            columns = resolve_columns(next(reader, []))
+            ip_col, port_col = columns["ip"], columns["port"]
+            if ip_col is None or port_col is None:
+                return records
+            code_col, latency_col, speed_col = columns["code"], columns["latency"], columns["speed"]
+            width = max(ip_col, port_col)
             for row in reader:
-                ip = next((row.get(alias) for alias in HEADER_ALIASES["ip"] if row.get(alias)), None)
-                port = next((row.get(alias) for alias in HEADER_ALIASES["port"] if row.get(alias)), None)
-                code = next((row.get(alias) for alias in HEADER_ALIASES["code"] if row.get(alias)), None)
-                if ip and port and code: 
-                    result_lines.append(f"{ip.strip()}:{port.strip()}#{code.strip()}")
-    except Exception as e: 
-        print(f"❌ 处理CSV文件 '{input_csv.name}' 时发生错误: {e}")
-        return []
-    print(f"✅ 从 '{input_csv.name}' 中提取到 {len(result_lines)} 条有效记录。")
+                if len(row) <= width:
+                    continue
+                ip, port = row[ip_col].strip(), row[port_col].strip()
+                if not ip or not port.isdigit():
+                    continue
+                records.append({
+                    "ip": ip, "port": int(port),
+                    "code": row[code_col].strip() if code_col is not None and code_col < len(row) else "",
+                    "latency_ms": parse_metric(row[latency_col]) if latency_col is not None and latency_col < len(row) else None,
+                    "speed": parse_metric(row[speed_col]) if speed_col is not None and speed_col < len(row) else None,
+                })
+    except (OSError, csv.Error):
+        pass
+    return records
+
+def rows_endpoints(rows: List[Dict[str, Any]]) -> EndpointSet:
+    """批次结果行中出现的全部 IP:端口。"""
+    return EndpointSet(key for key in (parse_line(f"{r['ip']} {r['port']}") for r in rows) if key is not None)
+
+def rows_mean_speed(rows: List[Dict[str, Any]]) -> Optional[float]:
+    """批次结果的平均下载速度 (供自适应并发参考)，无速度数据时返回 None。"""
+    speeds = [r["speed"] for r in rows if r["speed"]]
+    return sum(speeds) / len(speeds) if speeds else None
+
+def new_quota() -> Optional[scheduler.QuotaTracker]:
+    """按配置创建提前结束的配额，未启用时返回 None。"""
+    if TEST_QUOTA <= 0:
+        return None
+    countries = [c.strip() for c in TEST_QUOTA_COUNTRIES.split(',') if c.strip()]
+    ports = [int(p) for p in TEST_QUOTA_PORTS.split(',') if p.strip().isdigit()]
+    return scheduler.QuotaTracker(TEST_QUOTA, countries, ports)
+
+def count_result_rows(quota: Optional[scheduler.QuotaTracker], rows: List[Dict[str, Any]]) -> None:
+    """把批次结果行中的有效结果计入配额。"""
+    if quota is None:
+        return
+    for row in rows:
+        if row["code"]:
+            quota.add(row["code"], row["port"])
+
+def count_result_lines(quota: Optional[scheduler.QuotaTracker], result_lines: Iterable[str]) -> None:
+    """把 'IP:端口#国家' 格式的结果 (例如复用的历史结果) 计入配额。"""
+    if quota is None:
+        return
+    for line in result_lines:
+        endpoint, _, country = line.partition('#')
+        port = endpoint.rpartition(':')[2]
+        if port.isdigit():
+            quota.add(country, int(port))
+
+def process_results(records: List[Dict[str, Any]], label: str) -> List[str]:
+    """把测速结果记录整理为 'IP:端口#国家' 行并写入测速历史库；只保留带国际代码的记录。"""
+    valid = [r for r in records if r["code"]]
+    result_lines = [f"{r['ip']}:{r['port']}#{r['code']}" for r in valid]
+    try:
+        ip_history.record_results({"ip": r["ip"], "port": r["port"], "country": r["code"],
+                                   "latency_ms": r["latency_ms"], "speed": r["speed"]} for r in valid)
+    except sqlite3.Error as e:
+        print(f"❌ 写入测速历史库失败: {e}")
+    print(f"✅ 从 '{label}' 的测速结果中提取到 {len(result_lines)} 条有效记录。")
     return result_lines
 
 def convert_api_content_for_test(api_content: str) -> Optional[Path]:
@@ -379,9 +777,272 @@ def convert_api_content_for_test(api_content: str) -> Optional[Path]:
         print(f"❌ 写入API临时文件失败: {e}")
         return None
 
-def test_and_process_ips(input_file: Path, output_csv: Path) -> List[str]:
-    run_iptest(input_file, output_csv)
-    return process_ip_csv(output_csv)
+def prefilter_candidates(candidates: EndpointSet, label: str) -> EndpointSet:
+    """漏斗第一级：TCP 握手预筛，只返回存活且握手延迟达标的IP。未启用时原样返回。"""
+    if not PREFILTER_ENABLED or not candidates:
+        return candidates
+    max_rtt = int(IPTEST_DELAY) * PREFILTER_RTT_FACTOR
+    print(f"--- [预筛] 正在对 '{label}' 的 {len(candidates)} 个IP进行TCP握手探测 (上限 {max_rtt:.0f} ms) ---")
+    started = time.time()
+    alive = native_iptest.tcp_prefilter(candidates.to_endpoints(), PREFILTER_CONCURRENCY, max_rtt, PREFILTER_DEADLINE)
+    print(f"✅ 预筛完成，耗时 {time.time() - started:.1f}s，存活 {len(alive)}/{len(candidates)} 个IP进入完整测速。")
+    return EndpointSet(pack(ip, port) for ip, port in alive)
+
+def reuse_history(candidates: EndpointSet) -> Tuple[EndpointSet, List[str]]:
+    """跳过 TTL 内已测速成功的IP，返回 (仍需测速的IP, 复用的结果行)。"""
+    if HISTORY_TTL_HOURS <= 0:
+        return candidates, []
+    try:
+        pending, reused = ip_history.split_by_ttl(candidates, HISTORY_TTL_HOURS * 3600)
+    except sqlite3.Error as e:
+        print(f"❌ 读取测速历史库失败，将全部重新测速: {e}")
+        return candidates, []
+    if reused:
+        print(f"♻️ {len(reused)} 个IP在 {HISTORY_TTL_HOURS:g} 小时内已测速成功，直接复用历史结果。")
+    return pending, [f"{r['ip']}:{r['port']}#{r['country']}" for r in reused]
+
+def load_priority_model() -> Optional[scheduler.PriorityModel]:
+    """根据历史测速结果构建排序模型；未启用、没有历史或读取失败时返回 None (按IP数值顺序测速)。"""
+    if not PRIORITY_ORDER:
+        return None
+    try:
+        model = scheduler.PriorityModel(*ip_history.quality_history())
+    except sqlite3.Error as e:
+        print(f"❌ 读取测速历史库失败，按原顺序测速: {e}")
+        return None
+    if not model:
+        return None
+    print("📊 已根据历史测速结果按预估质量排列测速顺序，可能表现好的IP优先测速。")
+    return model
+
+def prioritized_lines(candidates: EndpointSet, model: Optional[scheduler.PriorityModel]) -> Iterator[str]:
+    """按排序模型输出 'IP 端口' 行，无模型时按IP数值顺序。"""
+    if model is None:
+        return candidates.lines()
+    return (format_key(key) for key in model.order(candidates.keys()))
+
+def load_country_index() -> Optional[geoindex.CountryIndex]:
+    """加载离线国家索引；未配置、文件缺失或为空时返回 None (不过滤)。"""
+    if not GEO_DB_PATH or not GEO_ALLOWED_COUNTRIES.strip():
+        return None
+    path = Path(GEO_DB_PATH)
+    if not path.is_absolute():
+        path = BASE_DIR / path
+    try:
+        index = geoindex.CountryIndex.load(path)
+    except OSError as e:
+        print(f"❌ 读取国家数据库 '{path.name}' 失败，跳过国家过滤: {e}")
+        return None
+    if not index:
+        print(f"⚠️ 国家数据库 '{path.name}' 中没有可识别的 IPv4 网段，跳过国家过滤。")
+        return None
+    return index
+
+def geo_filter(index: Optional[geoindex.CountryIndex], candidates: EndpointSet) -> EndpointSet:
+    """测速前按允许国家过滤候选IP。"""
+    if index is None or not candidates:
+        return candidates
+    countries = [c.strip() for c in GEO_ALLOWED_COUNTRIES.split(',') if c.strip()]
+    kept = index.filter(candidates, countries, GEO_KEEP_UNKNOWN)
+    if len(kept) < len(candidates):
+        print(f"🌍 国家过滤：{len(candidates) - len(kept)} 个IP不在允许的国家 ({','.join(countries)}) 内，已跳过。")
+    return kept
+
+def test_fingerprint(*parts: bytes) -> str:
+    """断点日志的输入指纹：候选IP与影响测速结果的配置，任一变化都不再续用旧日志。"""
+    digest = hashlib.sha256("|".join(map(str, (IPTEST_ENGINE, SPEED_TEST_URL, IPTEST_MAX, IPTEST_SPEEDTEST,
+                                                IPTEST_SPEEDLIMIT, IPTEST_DELAY))).encode('utf-8'))
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+def open_journal(output_csv: Path, fingerprint: str) -> Optional[run_journal.RunJournal]:
+    """打开 output_csv 对应测速阶段的断点日志，未启用或无法创建时返回 None。"""
+    if not JOURNAL_ENABLED:
+        return None
+    try:
+        return run_journal.RunJournal(JOURNAL_DIR / output_csv.stem, fingerprint, JOURNAL_MAX_AGE_HOURS)
+    except OSError as e:
+        print(f"❌ 无法创建断点日志，本次中断后将无法续测: {e}")
+        return None
+
+def new_sampler() -> Optional[scheduler.SamplingPlanner]:
+    return scheduler.SamplingPlanner(SAMPLE_PER_GROUP) if SAMPLING_ENABLED else None
+
+def sample_candidates(sampler: Optional[scheduler.SamplingPlanner], candidates: EndpointSet, reused_lines: List[str],
+                      model: Optional[scheduler.PriorityModel], exempt: Collection[int]) -> EndpointSet:
+    """抽样第一轮：复用了历史结果的分组视为已通过；其余分组按排序挑出代表，豁免的 (旧) IP 原样保留。"""
+    if sampler is None:
+        return candidates
+    sampler.mark_passed(key for key in map(result_key, reused_lines) if key is not None)
+    keys = model.order(candidates.keys()) if model else candidates.keys()
+    selected = EndpointSet(sampler.plan(keys, exempt))
+    if len(selected) < len(candidates):
+        print(f"🔬 分组抽样：{len(candidates)} 个候选IP先测 {len(selected)} 个，"
+              f"其余 {len(candidates) - len(selected)} 个待同组代表测速通过后再测。")
+    return selected
+
+def expand_sampled(sampler: scheduler.SamplingPlanner, records: List[Dict[str, Any]], output_csv: Path,
+                   quota: Optional[scheduler.QuotaTracker], model: Optional[scheduler.PriorityModel],
+                   label: str, fingerprint: str) -> Tuple[EndpointSet, EndpointSet]:
+    """
+    抽样第二轮：以第一轮结果记录判定各分组，代表有结果的分组展开测速其余成员并把结果追加到 records
+    (以及留档的 output_csv)，代表全部失败的分组整组跳过。返回 (预筛淘汰的IP, 跑完测速的IP)，供更新负缓存。
+    """
+    passed = rows_endpoints([row for row in records if row["code"]])
+    sampler.mark_passed(passed.keys())
+    keys, skipped_groups, skipped = sampler.expansions()
+    if quota is not None and quota.met:
+        return EndpointSet(), EndpointSet()
+    if skipped:
+        print(f"✂️ 分组抽样：{skipped_groups} 个分组的代表全部未通过，跳过其余 {skipped} 个IP。")
+    if not keys:
+        return EndpointSet(), EndpointSet()
+    expansions = EndpointSet(keys)
+    print(f"🔬 分组抽样：展开代表测速通过的分组，继续测速其余 {len(expansions)} 个IP。")
+    alive = prefilter_candidates(expansions, label)
+    expand_csv = output_csv.with_name(f"{output_csv.stem}_expand.csv")
+    if expand_csv.exists():
+        expand_csv.unlink()
+    tested, more_records = run_batches(iter_batches(prioritized_lines(alive, model), TEST_BATCH_SIZE), expand_csv, quota,
+                                       open_journal(expand_csv, fingerprint))
+    records.extend(more_records)
+    if expand_csv.exists():
+        merge_csv([expand_csv], output_csv, append=True)
+        expand_csv.unlink()
+    return expansions - alive, tested
+
+def result_key(line: str) -> Optional[int]:
+    """把 'IP:端口#国家' 格式的结果行还原为打包键。"""
+    return parse_line(line.split('#', 1)[0].replace(':', ' '))
+
+def update_negative_cache(dropped: EndpointSet, tested: EndpointSet, result_lines: List[str]) -> None:
+    """
+    根据本次测速结果更新负缓存：预筛淘汰或所在批次跑完却无结果的IP记一次失败，
+    出现在结果中的IP清零。批次本身执行失败的IP不计入，以免误伤。
+    """
+    succeeded = EndpointSet(key for key in map(result_key, result_lines) if key is not None)
+    failed = (dropped | (tested - succeeded)) - succeeded
+    try:
+        ip_history.record_outcomes(failed.to_endpoints(), succeeded.to_endpoints())
+    except sqlite3.Error as e:
+        print(f"❌ 更新负缓存失败: {e}")
+
+def test_and_process_ips(candidates: EndpointSet, label: str, output_csv: Path, exempt: Collection[int] = ()) -> List[str]:
+    """
+    对内存中的候选集合完成 (国家过滤) -> 历史复用 -> (分组抽样) -> 预筛 -> 测速 -> 解析；label 为来源文件名，用于提示与临时文件命名。
+    exempt 中的IP (旧IP) 不参与抽样，总是测速。
+    """
+    # 清理上次运行遗留的结果文件，避免本次未测速时误读旧数据
+    if output_csv.exists():
+        output_csv.unlink()
+    fingerprint = test_fingerprint(label.encode('utf-8'), candidates.keys().tobytes())
+    candidates = geo_filter(load_country_index(), candidates)
+    if not candidates:
+        return []
+    candidates, reused_lines = reuse_history(candidates)
+    quota = new_quota()
+    count_result_lines(quota, reused_lines)
+    model = load_priority_model()
+    sampler = new_sampler()
+    candidates = sample_candidates(sampler, candidates, reused_lines, model, exempt)
+    alive = prefilter_candidates(candidates, label)
+    dropped = candidates - alive
+    print(f"--- [测速] 正在对 '{label}' 的 {len(alive)} 个IP进行测速 (引擎: {IPTEST_ENGINE}) ---")
+    tested, records = run_batches(iter_batches(prioritized_lines(alive, model), TEST_BATCH_SIZE), output_csv, quota,
+                                  open_journal(output_csv, fingerprint))
+    if sampler:
+        more_dropped, more_tested = expand_sampled(sampler, records, output_csv, quota, model, label, fingerprint)
+        dropped, tested = dropped | more_dropped, tested | more_tested
+    result_lines = process_results(records, label)
+    update_negative_cache(dropped, tested, result_lines)
+    return reused_lines + result_lines
+
+def pipeline_test_and_process(mode: str, old_candidates: EndpointSet, output_csv: Path) -> Tuple[List[str], EndpointSet]:
+    """
+    流水线版 test_and_process_ips：旧IP先入队测速；提取模块每放行一组新候选，剔除其中已作为旧IP排队的部分，
+    立即做国家过滤、历史复用 (与分组抽样) 和TCP预筛，按历史质量排序后切成 TEST_BATCH_SIZE 大小的批次交给测速线程池，
+    首批结果无需等待全部解析完成。启用抽样时，流水线结束后再展开代表通过的分组。
+    返回 (有效结果行, 本次提取到的全部新IP)。
+    """
+    if output_csv.exists():
+        output_csv.unlink()
+    reused_lines: List[str] = []
+    dropped = EndpointSet()
+    new_candidates = EndpointSet()
+    quota = new_quota()
+    model = load_priority_model()
+    sampler = new_sampler()
+    country_index = load_country_index()
+    stream = open_extractor(mode, max(1, PIPELINE_QUEUE_SIZE))
+
+    def candidate_chunks() -> Iterator[EndpointSet]:
+        old_keys = model.order(old_candidates.keys()) if model else old_candidates.keys()
+        for i in range(0, len(old_keys), PIPELINE_CHUNK_SIZE):
+            yield EndpointSet(old_keys[i:i + PIPELINE_CHUNK_SIZE])
+        for chunk in stream.chunks(PIPELINE_CHUNK_SIZE, PIPELINE_LINGER):
+            chunk = EndpointSet(chunk)
+            new_candidates.update(chunk.keys())
+            yield chunk - old_candidates
+
+    def screened_batches() -> Iterator[List[str]]:
+        for chunk in candidate_chunks():
+            if quota is not None and quota.met:
+                # 配额已达标，不再预筛新候选 (它们已计入 new_candidates)，其余候选在收尾时取走
+                return
+            candidates, reused = reuse_history(geo_filter(country_index, chunk))
+            reused_lines.extend(reused)
+            count_result_lines(quota, reused)
+            candidates = sample_candidates(sampler, candidates, reused, model, old_candidates)
+            alive = prefilter_candidates(candidates, IP_TXT.name)
+            dropped.update((candidates - alive).keys())
+            yield from iter_batches(prioritized_lines(alive, model), TEST_BATCH_SIZE)
+
+    module_name = "ipccc" if mode == "1" else "cmip_downloader"
+    print(f"--- [测速] 正在对旧IP及 {module_name} 流式产出的候选IP进行测速 (引擎: {IPTEST_ENGINE}) ---")
+    # 流水线的新IP在测速前无法全部得知，指纹只覆盖模式与旧IP；续测时按IP跳过上次已完成的部分
+    fingerprint = test_fingerprint(mode.encode('utf-8'), old_candidates.keys().tobytes())
+    tested, records = run_batches(screened_batches(), output_csv, quota, open_journal(output_csv, fingerprint))
+    if not stream.ended:
+        # 配额达标提前结束时提取线程仍阻塞在满队列上：取走剩余候选 (不再测速)，
+        # 让提取模块正常跑完并写出候选缓存、成员索引与 ip.txt，下次运行的条件请求与增量解析才不会失效
+        print(f"⏳ 测速已提前结束，等待 {module_name} 完成提取以保存缓存...")
+        try:
+            new_candidates.update(stream.drain())
+        except ExtractionError as e:
+            print(f"⚠️ {e}")
+    if sampler:
+        more_dropped, more_tested = expand_sampled(sampler, records, output_csv, quota, model, IP_TXT.name, fingerprint)
+        dropped.update(more_dropped.keys())
+        tested = tested | more_tested
+    result_lines = process_results(records, IP_TXT.name)
+    update_negative_cache(dropped, tested, result_lines)
+    return reused_lines + result_lines, new_candidates
+
+def load_old_candidates(data_source: str) -> EndpointSet:
+    """下载数据源中的历史IP并转换为候选集合，用于与新IP合并后统一复测。"""
+    old_content = None
+    if data_source == 'api':
+        old_content = download_from_custom_api()
+    elif data_source == 'gist':
+        old_content = download_from_gist()
+    if not old_content:
+        return EndpointSet()
+    api_test_input_file = convert_api_content_for_test(old_content)
+    if not api_test_input_file:
+        return EndpointSet()
+    return EndpointSet.read_file(api_test_input_file)
+
+def summarize_provenance(valid_ips: List[str], new_candidates: EndpointSet, old_candidates: EndpointSet) -> Tuple[List[str], str]:
+    """按来源 (新/旧/两者) 统计有效结果，返回 (去重排序后的最终列表, 统计文本)。"""
+    unique_ips = sorted(set(valid_ips))
+    keys = [result_key(line) for line in unique_ips]
+    new_valid = sum(1 for key in keys if key is not None and key in new_candidates)
+    old_valid = sum(1 for key in keys if key is not None and key in old_candidates)
+    overlap = len(new_candidates & old_candidates)
+    stats = (f"   - 新IP有效数: `{new_valid}`\n   - 旧IP有效数: `{old_valid}`\n"
+             f"   - 新旧重复IP (只测一次): `{overlap}`\n   - 去重后最终数: `{len(unique_ips)}`")
+    return unique_ips, stats
 
 # ==============================================================================
 # --- 主流程函数 ---
@@ -408,7 +1069,10 @@ def main() -> None:
 
     def handle_termination(signum, frame):
         logger.info('收到终止信号 (%s)，准备退出...', signum)
-        send_tg_notification('⚠️ IP 处理任务收到终止信号，正在退出...')
+        if JOURNAL_ENABLED:
+            send_tg_notification('⚠️ IP 处理任务收到终止信号，正在退出...\n已完成的测速批次已保存，下次运行将自动续测。')
+        else:
+            send_tg_notification('⚠️ IP 处理任务收到终止信号，正在退出...')
         remove_pid()
         sys.exit(0)
 
@@ -422,6 +1086,7 @@ def main() -> None:
     if not all([SPEED_TEST_URL, TG_BOT_TOKEN, TG_CHAT_ID]):
         print("❌ 错误：.env 文件中的基础配置不完整 (SPEED_TEST_URL, TG_BOT_TOKEN, TG_CHAT_ID)。")
         sys.exit(1)
+    warn_inert_bandwidth_budget()
         
     start_time = datetime.now()
     
@@ -437,45 +1102,30 @@ def main() -> None:
         send_tg_notification(f"🚀 *IP全流程处理任务开始*\n\n*数据源*: `{data_source}`\n*开始时间*: `{start_time.strftime('%Y-%m-%d %H:%M:%S')}`")
 
         mode = choose_mode()
-        run_script(mode)
-        
-        with ThreadPoolExecutor(max_workers=max(1, TEST_CONCURRENCY), thread_name_prefix='IPTest') as executor:
-            print("\n--- [步骤2: 并行测速] 已启动新旧IP并行测速 ---")
-            future_new_ips = executor.submit(test_and_process_ips, IP_TXT, NEW_IP_TEST_RESULT_CSV)
-            
-            future_old_ips = None
-            old_content = None
-            if data_source == 'api':
-                old_content = download_from_custom_api()
-            elif data_source == 'gist':
-                old_content = download_from_gist()
-
-            if old_content:
-                api_test_input_file = convert_api_content_for_test(old_content)
-                if api_test_input_file:
-                    future_old_ips = executor.submit(test_and_process_ips, api_test_input_file, OLD_IP_TEST_RESULT_CSV)
-            
-            new_valid_ips = []
-            try:
-                print("⏳ 正在等待新IP测速任务完成..."); 
-                new_valid_ips = future_new_ips.result()
-                print("✅ 新IP测速任务完成。")
-            except Exception as e: 
-                print(f"❌ 处理新IP的线程发生错误: {e}")
-
-            old_valid_ips = []
-            if future_old_ips:
-                try:
-                    print("⏳ 正在等待旧IP测速任务完成..."); 
-                    old_valid_ips = future_old_ips.result()
-                    print("✅ 旧IP测速任务完成。")
-                except Exception as e: 
-                    print(f"❌ 处理旧IP的线程发生错误: {e}")
+        # 新旧IP合并为一个候选集合统一测速：同时出现在两边的IP只测一次，来源在统计时再区分
+        old_candidates = load_old_candidates(data_source)
+        valid_ips: List[str] = []
+        new_candidates = EndpointSet()
+        try:
+            if PIPELINE_ENABLED:
+                print("\n--- [步骤1+2: 流水线] 旧IP优先测速，新IP边提取边测速 ---")
+                valid_ips, new_candidates = pipeline_test_and_process(mode, old_candidates, IP_TEST_RESULT_CSV)
+            else:
+                new_candidates = extract_candidates(mode)
+                candidates = new_candidates | old_candidates
+                print(f"\n--- [步骤2: 统一测速] 新IP {len(new_candidates)} 个 + 旧IP {len(old_candidates)} 个，去重后共 {len(candidates)} 个 ---")
+                valid_ips = test_and_process_ips(candidates, IP_TXT.name, IP_TEST_RESULT_CSV, old_candidates)
+            print("✅ 测速任务完成。")
+        except ExtractionError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        except Exception as e:
+            # 测速失败时结果不完整，不能用它覆盖数据源中的有效列表：交给外层发送失败通知并跳过上传
+            print(f"❌ 测速任务发生错误，已中止上传以防止覆盖有效数据: {e}")
+            raise
 
         print("\n--- [步骤3: 合并与保存] ---")
-        all_ips = set(new_valid_ips) | set(old_valid_ips)
-        unique_ips = sorted(list(all_ips))
-        stats = f"   - 新IP有效数: `{len(new_valid_ips)}`\n   - 旧IP有效数: `{len(old_valid_ips)}`\n   - 去重后最终数: `{len(unique_ips)}`"
+        unique_ips, stats = summarize_provenance(valid_ips, new_candidates, old_candidates)
         print(stats.replace('`', ''))
         
         final_content = "\n".join(unique_ips)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+原生 asyncio 测速引擎 (iptest.exe 的跨平台替代)
+- 在单个事件循环内并发完成 TCP 延迟、TLS/HTTP 可达性与下载速度三项检测。
+- 参数语义与 iptest.exe 保持一致 (-max / -speedtest / -speedlimit / -delay / -url)。
+- 输出与 iptest.exe 相同的 CSV 列，main.parse_batch_csv 可直接解析。
+- 可接入全局带宽预算 (scheduler.BandwidthBudget)：每次下载测速占用一个全局槽位，并按实际字节数扣减额度。
+"""
+import asyncio
+import csv
+import json
+import ssl
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+
+from scheduler import BandwidthBudget
+
+# --- 常量定义 ---
+BASE_DIR = Path(__file__).parent.resolve()
+# 与 iptest.exe 共用同一份数据中心位置文件
+LOCATIONS_JSON = BASE_DIR / "locations.json"
+LOCATIONS_URL = "https://speed.cloudflare.com/locations"
+# Cloudflare 支持 HTTPS 的端口，其余端口按明文 HTTP 处理
+TLS_PORTS = {443, 2053, 2083, 2087, 2096, 8443}
+TRACE_PATH = "/cdn-cgi/trace"
+CSV_HEADER = ["IP地址", "端口", "TLS", "数据中心", "地区", "国际代码", "城市", "网络延迟", "下载速度"]
+READ_CHUNK = 64 * 1024
+
+_locations_cache: Optional[Dict[str, Dict[str, str]]] = None
+_locations_lock = threading.Lock()
+
+
+def load_locations() -> Dict[str, Dict[str, str]]:
+    """加载数据中心(colo)到国家/地区的映射，本地不存在时从 Cloudflare 下载一次。"""
+    global _locations_cache
+    with _locations_lock:
+        if _locations_cache is None:
+            _locations_cache = _read_locations()
+        return _locations_cache
+
+
+def _read_locations() -> Dict[str, Dict[str, str]]:
+    data = []
+    try:
+        if LOCATIONS_JSON.exists():
+            data = json.loads(LOCATIONS_JSON.read_text(encoding='utf-8'))
+        else:
+            print(f"[*] 本地未找到 '{LOCATIONS_JSON.name}'，正在从 {LOCATIONS_URL} 下载...")
+            response = requests.get(LOCATIONS_URL, timeout=15)
+            response.raise_for_status()
+            data = response.json()
+            LOCATIONS_JSON.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    except (requests.exceptions.RequestException, ValueError, OSError) as e:
+        print(f"[-] 加载数据中心位置信息失败，国际代码将以数据中心代码代替: {e}")
+    return {
+        str(item.get("iata", "")).upper(): {
+            "region": item.get("region", ""),
+            "cca2": item.get("cca2", ""),
+            "city": item.get("city", ""),
+        }
+        for item in data if isinstance(item, dict) and item.get("iata")
+    }
+
+
+def parse_speed_url(url: str) -> Tuple[str, str]:
+    """将 SPEED_TEST_URL (可省略协议头，与 iptest.exe 一致) 拆分为 Host 与请求路径。"""
+    if "://" not in url:
+        url = "https://" + url
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return parts.netloc, path
+
+
+def read_endpoints(in_path: Path) -> List[Tuple[str, int]]:
+    """读取 iptest 格式的输入文件 (每行 'IP 端口')。"""
+    endpoints: List[Tuple[str, int]] = []
+    with in_path.open('r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                endpoints.append((parts[0], int(parts[1])))
+    return endpoints
+
+
+async def _close_writer(writer) -> None:
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+
+async def tcp_latency(ip: str, port: int, max_rtt_ms: float) -> Optional[float]:
+    """一次 TCP 握手的耗时 (ms)；超时、拒绝或超过上限时返回 None。"""
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=max_rtt_ms / 1000)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    latency = (time.perf_counter() - start) * 1000
+    await _close_writer(writer)
+    return latency if latency <= max_rtt_ms else None
+
+
+async def _prefilter(endpoints: List[Tuple[str, int]], concurrency: int, max_rtt_ms: float,
+                     deadline: float) -> List[Tuple[str, int]]:
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def check(ip: str, port: int) -> bool:
+        async with sem:
+            return await tcp_latency(ip, port, max_rtt_ms) is not None
+
+    tasks = [asyncio.ensure_future(check(ip, port)) for ip, port in endpoints]
+    done, pending = await asyncio.wait(tasks, timeout=deadline if deadline > 0 else None)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    # 截止时间到达仍未探测完成的目标保守保留，交由完整测速判定
+    return [ep for ep, task in zip(endpoints, tasks) if task in pending or task.result()]
+
+
+def tcp_prefilter(endpoints: List[Tuple[str, int]], concurrency: int, max_rtt_ms: float,
+                  deadline: float) -> List[Tuple[str, int]]:
+    """
+    漏斗第一级：高并发 TCP 握手探测，只保留握手耗时不超过 max_rtt_ms 的目标。
+    deadline 为整个阶段的时间上限 (秒，<=0 表示不限)。
+    """
+    if not endpoints:
+        return []
+    return asyncio.run(_prefilter(endpoints, concurrency, max_rtt_ms, deadline))
+
+
+class NativeTester:
+    """单事件循环内的并发测速器，一个实例对应一次 iptest 批次运行。"""
+
+    def __init__(self, url: str, max_conn: int, speedtest: int, speedlimit: float,
+                 delay_ms: int, http_timeout: float, download_seconds: float,
+                 budget: Optional[BandwidthBudget] = None):
+        self.host, self.path = parse_speed_url(url)
+        self.max_conn = max(1, max_conn)
+        self.speedtest = max(0, speedtest)
+        self.speedlimit = speedlimit
+        self.delay_ms = delay_ms
+        self.http_timeout = http_timeout
+        self.download_seconds = download_seconds
+        self.budget = budget
+        self.locations = load_locations()
+        self.ssl_context = ssl.create_default_context()
+        # 优选 IP 常以非源站证书应答，与 iptest.exe 一样不校验证书
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def _open(self, ip: str, port: int, timeout: float):
+        use_tls = port in TLS_PORTS
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                ip, port,
+                ssl=self.ssl_context if use_tls else None,
+                server_hostname=self.host.split(':')[0] if use_tls else None,
+            ),
+            timeout=timeout,
+        )
+
+    async def _request_head(self, reader, writer, path: str) -> Tuple[int, Dict[str, str], bytes]:
+        """发送 GET 请求并读取响应头，返回 (状态码, 头部, 已读到的正文片段)。"""
+        request = (
+            f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            "User-Agent: Mozilla/5.0\r\nAccept: */*\r\nConnection: close\r\n\r\n"
+        )
+        writer.write(request.encode('ascii'))
+        await writer.drain()
+        buf = b""
+        while b"\r\n\r\n" not in buf:
+            chunk = await reader.read(READ_CHUNK)
+            if not chunk:
+                break
+            buf += chunk
+            if len(buf) > 65536:
+                break
+        head, _, body = buf.partition(b"\r\n\r\n")
+        lines = head.decode('latin-1').split("\r\n")
+        status_parts = lines[0].split() if lines else []
+        status = int(status_parts[1]) if len(status_parts) >= 2 and status_parts[1].isdigit() else 0
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(":")
+            if sep:
+                headers[key.strip().lower()] = value.strip()
+        return status, headers, body
+
+    async def measure_latency(self, ip: str, port: int) -> Optional[float]:
+        """TCP 握手耗时 (ms)，超过 delay 上限视为失败。"""
+        return await tcp_latency(ip, port, self.delay_ms)
+
+    async def fetch_colo(self, ip: str, port: int) -> Optional[str]:
+        """请求 /cdn-cgi/trace 验证 TLS/HTTP 可达性，并取得数据中心代码。"""
+        try:
+            reader, writer = await self._open(ip, port, self.http_timeout)
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            return None
+        try:
+            status, headers, body = await asyncio.wait_for(
+                self._request_head(reader, writer, TRACE_PATH), timeout=self.http_timeout
+            )
+            if status == 0:
+                return None
+            while len(body) < 4096:
+                chunk = await asyncio.wait_for(reader.read(READ_CHUNK), timeout=self.http_timeout)
+                if not chunk:
+                    break
+                body += chunk
+            for line in body.decode('utf-8', errors='ignore').splitlines():
+                if line.startswith("colo="):
+                    return line[5:].strip().upper()
+            cf_ray = headers.get("cf-ray", "")
+            if "-" in cf_ray:
+                return cf_ray.rsplit("-", 1)[1].upper()
+            return None
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            return None
+        finally:
+            await _close_writer(writer)
+
+    async def measure_speed(self, ip: str, port: int) -> Tuple[Optional[float], int]:
+        """在限定时间内下载测速文件，返回 (平均速度 MB/s, 实际下载字节数)。"""
+        received = 0
+        try:
+            reader, writer = await self._open(ip, port, self.http_timeout)
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            return None, received
+        try:
+            status, _, body = await asyncio.wait_for(
+                self._request_head(reader, writer, self.path), timeout=self.http_timeout
+            )
+            if not 200 <= status < 300:
+                return None, received
+            received = len(body)
+            start = time.perf_counter()
+            deadline = start + self.download_seconds
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    chunk = await asyncio.wait_for(reader.read(READ_CHUNK), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    break
+                received += len(chunk)
+            elapsed = max(time.perf_counter() - start, 1e-3)
+            return received / elapsed / (1024 * 1024), received
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            return None, received
+        finally:
+            await _close_writer(writer)
+
+    async def probe(self, ip: str, port: int, conn_sem: asyncio.Semaphore,
+                    download_sem: Optional[asyncio.Semaphore]) -> Optional[List[str]]:
+        async with conn_sem:
+            latency = await self.measure_latency(ip, port)
+            if latency is None:
+                return None
+            colo = await self.fetch_colo(ip, port)
+            if not colo:
+                return None
+        speed_text = ""
+        if download_sem is not None:
+            async with download_sem:
+                if self.budget is None:
+                    speed, _ = await self.measure_speed(ip, port)
+                else:
+                    # 全局下载槽位与带宽额度由所有批次共享，延迟探测不受限制
+                    held = await self.budget.acquire_async()
+                    received = 0
+                    try:
+                        speed, received = await self.measure_speed(ip, port)
+                    finally:
+                        self.budget.release(held, received)
+            if speed is None or speed < self.speedlimit:
+                return None
+            speed_text = f"{speed:.2f}"
+        location = self.locations.get(colo, {})
+        return [
+            ip, str(port), str(port in TLS_PORTS).lower(), colo,
+            location.get("region", ""), location.get("cca2", "") or colo,
+            location.get("city", ""), f"{latency:.0f} ms", speed_text,
+        ]
+
+    async def run(self, endpoints: List[Tuple[str, int]],
+                  abort: Optional[threading.Event] = None) -> List[List[str]]:
+        """测速全部IP；abort 被设置时取消未完成的探测，只返回已完成部分的结果。"""
+        conn_sem = asyncio.Semaphore(self.max_conn)
+        download_sem = asyncio.Semaphore(self.speedtest) if self.speedtest > 0 else None
+        tasks = [asyncio.ensure_future(self.probe(ip, port, conn_sem, download_sem)) for ip, port in endpoints]
+        pending = set(tasks)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=0.5)
+            if pending and abort is not None and abort.is_set():
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                break
+        results = [t.result() for t in tasks if not t.cancelled() and t.exception() is None]
+        rows = [r for r in results if r]
+        # 与 iptest.exe 一致：有测速结果时按速度降序，否则按延迟升序
+        if download_sem is not None:
+            rows.sort(key=lambda r: -float(r[8]))
+        else:
+            rows.sort(key=lambda r: float(r[7].split()[0]))
+        return rows
+
+
+def run_batch_file(in_path: Path, out_path: Path, url: str, max_conn: int, speedtest: int,
+                   speedlimit: float, delay_ms: int, http_timeout: float, download_seconds: float,
+                   budget: Optional[BandwidthBudget] = None, abort: Optional[threading.Event] = None) -> int:
+    """
+    对一个批次输入文件测速并写出 CSV，返回有效结果数。可在任意线程中调用，budget 为跨批次共享的带宽预算。
+    abort 被设置时提前结束，已完成部分的结果照常写出。
+    """
+    tester = NativeTester(url, max_conn, speedtest, speedlimit, delay_ms, http_timeout, download_seconds, budget)
+    rows = asyncio.run(tester.run(read_endpoints(in_path), abort))
+    with out_path.open('w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        writer.writerows(rows)
+    return len(rows)
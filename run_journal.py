@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+测速断点续测日志
+- 每个测速阶段 (按结果文件区分) 使用一个日志目录，首行记录输入指纹与创建时间，
+  之后每完成一个批次追加一行：批次结果 CSV 与该批次已测完的IP键文件 (均为相对路径)，写入后立即 fsync。
+- 进程被终止 (/stop 发送的 SIGTERM、重启等) 后日志目录保留；下次以相同指纹启动时载入已完成的批次，
+  主流程只测尚未完成的IP，最后把新旧批次结果一起合并。
+- 指纹不一致、日志过期或损坏时丢弃旧日志重新开始；阶段正常结束后调用 finish 删除目录。
+- 每次运行的批次文件写在单独的子目录 (session_N) 中，不会覆盖之前记录的结果。
+"""
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Iterable, List
+
+from endpoints import EndpointSet
+
+JOURNAL_FILE = "journal.jsonl"
+
+
+class RunJournal:
+    def __init__(self, directory: Path, fingerprint: str, max_age_hours: float):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.completed = EndpointSet()
+        self.outputs: List[Path] = []
+        self.sessions = 0
+        if not self._load(max_age_hours):
+            shutil.rmtree(directory, ignore_errors=True)
+            directory.mkdir(parents=True, exist_ok=True)
+            self._append({"fingerprint": fingerprint, "created": time.time()})
+        self.work_dir = directory / f"session_{self.sessions + 1}"
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def resumed(self) -> bool:
+        return bool(self.outputs)
+
+    def _load(self, max_age_hours: float) -> bool:
+        """载入已有日志；指纹一致且未过期时返回 True。"""
+        path = self.directory / JOURNAL_FILE
+        if not path.exists():
+            return False
+        try:
+            with path.open('r', encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                if header.get("fingerprint") != self.fingerprint:
+                    return False
+                if max_age_hours > 0 and time.time() - header.get("created", 0) > max_age_hours * 3600:
+                    return False
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break       # 写入中途被终止的最后一行
+                    csv_path = self.directory / entry["csv"]
+                    keys_path = self.directory / entry["keys"]
+                    if csv_path.exists() and keys_path.exists():
+                        self.outputs.append(csv_path)
+                        self.completed.update(EndpointSet.load(keys_path).keys())
+        except (OSError, ValueError, KeyError):
+            return False
+        self.sessions = sum(1 for p in self.directory.glob("session_*") if p.is_dir())
+        return True
+
+    def _append(self, entry: dict) -> None:
+        with (self.directory / JOURNAL_FILE).open('a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, out_path: Path, keys: Iterable[int]) -> None:
+        """登记一个已完成 (或部分完成) 的批次：out_path 须位于 work_dir 中，keys 为其中已测完的IP。"""
+        keys_path = out_path.with_suffix('.keys')
+        with keys_path.open('wb') as f:
+            EndpointSet(keys).keys().tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._append({"csv": out_path.relative_to(self.directory).as_posix(),
+                      "keys": keys_path.relative_to(self.directory).as_posix()})
+
+    def finish(self) -> None:
+        """阶段正常结束，删除日志目录。"""
+        shutil.rmtree(self.directory, ignore_errors=True)
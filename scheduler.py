@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+测速调度
+- AimdController：按 加性增 / 乘性减 (AIMD) 调整同时运行的测速实例数。
+  批次失败或重试、批次耗时明显变长、平均测得速度明显下降时减半；连续一轮批次正常时 +1。
+  每次调整都会写入 run.log。
+- BandwidthBudget：全局下载槽位 + 令牌桶，限制同时进行的下载测速数与长期平均带宽。
+- QuotaTracker：按总数或按国家/端口统计有效结果，达到目标数量后主流程提前结束测速。
+- BatchFeed：在后台线程中迭代批次生成器，调度循环只取已就绪的批次，不会被生成器阻塞。
+- PriorityModel：根据历史测速结果估计候选IP的成功率与质量，按得分从高到低排列测速顺序。
+- SamplingPlanner：按 /24 网段 + 端口分组，每组先测少量代表，只有代表测速通过的分组才展开测速其余成员。
+"""
+import asyncio
+import logging
+import math
+import queue
+import statistics
+import threading
+import time
+from typing import Any, Collection, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AimdController:
+    """
+    线程安全的并发上限控制器。调用方在提交批次前读取 limit 与 epoch，批次结束后调用 record/on_failure。
+    只有在最近一次调整之后提交的批次 (epoch 不小于当前值) 才会被统计，避免同一次拥塞被重复惩罚。
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, slowdown: float = 1.5, ewma_alpha: float = 0.3):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = min(max(initial, self.minimum), self.maximum)
+        self.slowdown = slowdown
+        self.alpha = ewma_alpha
+        self.epoch = 0
+        self._good = 0
+        self._time: Optional[float] = None         # 批次耗时的指数滑动平均 (s)
+        self._best_time: Optional[float] = None
+        self._speed: Optional[float] = None        # 批次平均速度的指数滑动平均 (MB/s)
+        self._best_speed: Optional[float] = None
+        self._lock = threading.Lock()
+        logger.info("自适应并发启动: 初始 %d，范围 [%d, %d]", self._limit, self.minimum, self.maximum)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def _ewma(self, old: Optional[float], value: float) -> float:
+        return value if old is None else old + self.alpha * (value - old)
+
+    def _change(self, new_limit: int, reason: str) -> None:
+        new_limit = min(max(new_limit, self.minimum), self.maximum)
+        self._good = 0
+        if new_limit == self._limit:
+            return
+        logger.info("自适应并发 %d -> %d: %s", self._limit, new_limit, reason)
+        self._limit = new_limit
+        self.epoch += 1
+        # 滑动平均只反映当前并发下的表现，调整后重新开始统计 (最佳值保留)
+        self._time = None
+        self._speed = None
+
+    def _decrease(self, epoch: int, reason: str) -> None:
+        if epoch < self.epoch:
+            return
+        self._change(math.floor(self._limit / 2), reason)
+
+    def record(self, epoch: int, seconds: float, size: int, speed: Optional[float]) -> None:
+        """
+        登记一个成功完成的批次：耗时、IP 数与该批次测得的平均下载速度 (无结果时为 None)。
+        批次内各IP并发测速，耗时主要取决于超时与下载阶段而非行数，因此按整批耗时判断拥塞，
+        尾部的小批次与拆分出的子批次不会因为IP少而被误判为变慢；size 只用于日志。
+        """
+        with self._lock:
+            if epoch < self.epoch:
+                return
+            self._time = self._ewma(self._time, seconds)
+            self._best_time = self._time if self._best_time is None else min(self._best_time, self._time)
+            if speed is not None:
+                self._speed = self._ewma(self._speed, speed)
+                self._best_speed = self._speed if self._best_speed is None else max(self._best_speed, self._speed)
+            if self._time > self._best_time * self.slowdown:
+                self._decrease(epoch, f"批次耗时 {self._time:.1f}s ({size} 个IP) 超过最佳值 {self._best_time:.1f}s 的 {self.slowdown:g} 倍")
+            elif self._speed is not None and self._speed * self.slowdown < self._best_speed:
+                self._decrease(epoch, f"平均速度 {self._speed:.2f}MB/s 低于最佳值 {self._best_speed:.2f}MB/s 的 1/{self.slowdown:g}")
+            else:
+                self._good += 1
+                if self._good >= self._limit:
+                    self._change(self._limit + 1, f"连续 {self._good} 个批次正常 (批次耗时 {self._time:.1f}s)")
+
+    def on_failure(self, epoch: int, reason: str) -> None:
+        """批次失败或需要重试时立即减小并发。"""
+        with self._lock:
+            self._decrease(epoch, reason)
+
+
+class BandwidthBudget:
+    """
+    全局带宽预算，由所有测速线程 (iptest 实例与内置测速器) 共享。
+    - 下载槽位：同时进行的下载测速总数上限，各IP在相近的竞争条件下测速，结果可以互相比较。
+    - 令牌桶：额度按 rate_mbps 持续补充，每次下载结束后按实际字节数扣减 (允许透支)；
+      额度为负时新的下载需等待补足。长期平均速率不超过预算，而单次下载本身不被限速，测得速度不失真。
+    两项均可单独关闭 (slots / rate_mbps 设为 0)。延迟探测不受预算限制。
+    """
+
+    def __init__(self, slots: int, rate_mbps: float, burst_seconds: float = 10):
+        self.slots = max(0, slots)
+        self.rate = max(0.0, rate_mbps) * 1024 * 1024
+        self.capacity = self.rate * burst_seconds
+        self._available = self.slots
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _clip(self, n: int) -> int:
+        return min(max(1, n), self.slots) if self.slots else 0
+
+    def _debt_seconds(self) -> float:
+        """补充额度后返回还需等待多久才能还清透支 (调用方需持有锁)。"""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def _try_acquire(self, n: int) -> Optional[float]:
+        """尝试一次性占用 n 个槽位；成功时返回仍需等待的透支时长，槽位不足时返回 None。"""
+        with self._cond:
+            if self._available < n:
+                return None
+            self._available -= n
+            return self._debt_seconds()
+
+    def acquire(self, n: int = 1) -> int:
+        """阻塞直到一次性拿到 n 个槽位 (不会出现各持一部分的死锁) 且额度未透支，返回实际占用数。"""
+        n = self._clip(n)
+        with self._cond:
+            self._cond.wait_for(lambda: self._available >= n)
+            self._available -= n
+            wait = self._debt_seconds()
+        if wait > 0:
+            time.sleep(wait)
+        return n
+
+    async def acquire_async(self, n: int = 1) -> int:
+        """acquire 的协程版本，等待期间不阻塞事件循环。"""
+        n = self._clip(n)
+        while True:
+            wait = self._try_acquire(n)
+            if wait is not None:
+                break
+            await asyncio.sleep(0.05)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return n
+
+    def release(self, n: int, nbytes: int = 0) -> None:
+        """归还槽位，并按本次实际下载的字节数扣减额度。"""
+        with self._cond:
+            self._available += n
+            if self.rate and nbytes:
+                self._debt_seconds()
+                self._tokens -= nbytes
+            self._cond.notify_all()
+
+
+class QuotaTracker:
+    """
+    提前结束条件：已得到的有效结果达到目标数量即视为完成。
+    未指定国家/端口时按总数计算；指定后，列表中的每个国家 (与每个端口的组合) 都需要达到目标数量，
+    不在列表中的结果不计入。线程安全：复用的历史结果在批次生成线程中计入，测速结果在调度线程中计入。
+    """
+
+    def __init__(self, target: int, countries: Iterable[str] = (), ports: Iterable[int] = ()):
+        self.target = target
+        self.countries = [c.upper() for c in countries]
+        self.ports = list(ports)
+        self._counts: Dict[Tuple[Optional[str], Optional[int]], int] = {}
+        self._lock = threading.Lock()
+
+    def _groups(self) -> List[Tuple[Optional[str], Optional[int]]]:
+        return [(c, p) for c in (self.countries or [None]) for p in (self.ports or [None])]
+
+    def add(self, country: str, port: int) -> None:
+        country = country.upper()
+        if self.countries and country not in self.countries:
+            return
+        if self.ports and port not in self.ports:
+            return
+        key = (country if self.countries else None, port if self.ports else None)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    @property
+    def met(self) -> bool:
+        with self._lock:
+            return all(self._counts.get(group, 0) >= self.target for group in self._groups())
+
+    def summary(self) -> str:
+        parts = []
+        with self._lock:
+            for country, port in self._groups():
+                label = "/".join(str(x) for x in (country, port) if x is not None) or "总计"
+                parts.append(f"{label} {min(self._counts.get((country, port), 0), self.target)}/{self.target}")
+        return "，".join(parts)
+
+
+class BatchFeed:
+    """
+    在后台线程中迭代批次生成器，经有界队列交给调度循环。生成器内部可能长时间阻塞
+    (等待提取线程放行候选、TCP预筛等)，放到后台后调度循环仍能按时收集结果、检查配额与落后批次。
+    生成器抛出的异常在 get() 取到该位置时于调用方线程重新抛出。
+    stop() 之后后台线程在生成器产出下一个批次时退出并关闭生成器；close() 另外等待其退出。
+    """
+
+    _END = object()
+
+    def __init__(self, batches: Iterable[Any], maxsize: int = 2):
+        self._queue: "queue.Queue[Any]" = queue.Queue(max(1, maxsize))
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, args=(iter(batches),), name='BatchFeed', daemon=True)
+        self._thread.start()
+
+    def _put(self, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, batches: Iterator[Any]) -> None:
+        try:
+            for batch in batches:
+                if not self._put(batch):
+                    break
+        except BaseException as e:
+            self._error = e
+        finally:
+            close = getattr(batches, "close", None)
+            if close is not None:
+                close()
+            self._put(self._END)
+
+    def get(self, timeout: float = 0) -> Optional[Any]:
+        """
+        取下一个批次，生成器结束时返回 None。timeout 为 0 时只取已就绪的批次；
+        在 timeout 内没有就绪的批次时抛出 queue.Empty。
+        """
+        item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+        if item is self._END:
+            if self._error is not None:
+                raise self._error
+            return None
+        return item
+
+    def stop(self) -> None:
+        """不再需要更多批次：通知后台线程停止迭代，不等待其退出。"""
+        self._stop.set()
+
+    def close(self) -> None:
+        """停止并等待后台线程退出，此后生成器不再被其他线程使用。"""
+        self._stop.set()
+        self._thread.join()
+
+
+class PriorityModel:
+    """
+    测速顺序评分。候选IP以打包键表示 (高 32 位为 IPv4，低 16 位为端口)。
+    - 成功率：端口 -> /24 网段 -> IP 本身逐级收缩估计，样本越少越接近上一级的值
+      (IP 本身的历史按 endpoint_weight 倍计入；连续失败次数计为多次失败)。
+    - 质量：IP 自身的历史速度与延迟，缺失时使用所在 /24 网段的平均值，均相对历史中位数换算到 0~1。
+    得分 = 成功率 × (0.5 + 质量)，没有任何历史的IP得分相同，保持原有顺序。
+    """
+
+    def __init__(self, results: Iterable[Tuple[int, Optional[float], Optional[float]]],
+                 failures: Iterable[Tuple[int, int]], prior_weight: float = 4.0, endpoint_weight: float = 4.0):
+        self.prior_weight = prior_weight
+        self.endpoint_weight = endpoint_weight
+        self._endpoint_ok: Dict[int, Tuple[Optional[float], Optional[float]]] = {}
+        self._endpoint_fail: Dict[int, int] = {}
+        self._subnet: Dict[int, List[float]] = {}   # /24 -> [成功数, 失败数, 速度和, 速度数, 延迟和, 延迟数]
+        self._port: Dict[int, List[int]] = {}       # 端口 -> [成功数, 失败数]
+        speeds: List[float] = []
+        latencies: List[float] = []
+        for key, latency, speed in results:
+            self._endpoint_ok[key] = (latency, speed)
+            subnet = self._subnet.setdefault(key >> 24, [0, 0, 0.0, 0, 0.0, 0])
+            subnet[0] += 1
+            self._port.setdefault(key & 0xFFFF, [0, 0])[0] += 1
+            if speed:
+                subnet[2] += speed
+                subnet[3] += 1
+                speeds.append(speed)
+            if latency:
+                subnet[4] += latency
+                subnet[5] += 1
+                latencies.append(latency)
+        for key, count in failures:
+            self._endpoint_fail[key] = count
+            self._subnet.setdefault(key >> 24, [0, 0, 0.0, 0, 0.0, 0])[1] += 1
+            self._port.setdefault(key & 0xFFFF, [0, 0])[1] += 1
+        ok = sum(v[0] for v in self._port.values())
+        failed = sum(v[1] for v in self._port.values())
+        self._global_rate = (ok + 1) / (ok + failed + 2)
+        self._ref_speed = statistics.median(speeds) if speeds else None
+        self._ref_latency = statistics.median(latencies) if latencies else None
+
+    def __bool__(self) -> bool:
+        return bool(self._port)
+
+    def _shrink(self, ok: float, total: float, prior: float) -> float:
+        return (ok + self.prior_weight * prior) / (total + self.prior_weight)
+
+    def _quality(self, latency: Optional[float], speed: Optional[float]) -> float:
+        parts = []
+        if speed and self._ref_speed:
+            parts.append(speed / (speed + self._ref_speed))
+        if latency and self._ref_latency:
+            parts.append(self._ref_latency / (latency + self._ref_latency))
+        return sum(parts) / len(parts) if parts else 0.5
+
+    def score(self, key: int) -> float:
+        port_ok, port_failed = self._port.get(key & 0xFFFF, (0, 0))
+        rate = self._shrink(port_ok, port_ok + port_failed, self._global_rate)
+        subnet = self._subnet.get(key >> 24)
+        latency = speed = None
+        if subnet:
+            rate = self._shrink(subnet[0], subnet[0] + subnet[1], rate)
+            speed = subnet[2] / subnet[3] if subnet[3] else None
+            latency = subnet[4] / subnet[5] if subnet[5] else None
+        ok = 1 if key in self._endpoint_ok else 0
+        failed = self._endpoint_fail.get(key, 0)
+        if ok or failed:
+            rate = self._shrink(ok * self.endpoint_weight, (ok + failed) * self.endpoint_weight, rate)
+        if ok:
+            own_latency, own_speed = self._endpoint_ok[key]
+            latency = own_latency or latency
+            speed = own_speed or speed
+        return rate * (0.5 + self._quality(latency, speed))
+
+    def order(self, keys: Iterable[int]) -> List[int]:
+        """按得分从高到低排序 (稳定排序，同分时保持输入顺序)。"""
+        return sorted(keys, key=self.score, reverse=True)
+
+
+class SamplingPlanner:
+    """
+    分组抽样。同一 /24 网段、同一端口的IP (常见于整段收录的任播地址) 表现几乎一致，
+    每组只先放行 per_group 个代表，其余成员暂存；第一轮结束后调用 mark_passed 登记有结果的IP，
+    expansions 取出代表通过的分组的其余成员，代表全部失败的分组整组跳过。
+    已确认有效的分组 (例如复用了历史结果) 的后续成员直接放行。
+    """
+
+    def __init__(self, per_group: int):
+        self.per_group = max(1, per_group)
+        self._sampled: Dict[int, int] = {}
+        self._held: Dict[int, List[int]] = {}
+        self._passed: Set[int] = set()
+
+    @staticmethod
+    def group_of(key: int) -> int:
+        """分组键：/24 网段 (IPv4 高 24 位) 与端口。"""
+        return ((key >> 24) << 16) | (key & 0xFFFF)
+
+    def plan(self, keys: Iterable[int], exempt: Collection[int] = ()) -> List[int]:
+        """按输入顺序挑选本轮需要测速的IP (代表、豁免IP与已确认分组的成员)，其余暂存。"""
+        selected: List[int] = []
+        for key in keys:
+            group = self.group_of(key)
+            if key in exempt or group in self._passed:
+                selected.append(key)
+            elif self._sampled.get(group, 0) < self.per_group:
+                self._sampled[group] = self._sampled.get(group, 0) + 1
+                selected.append(key)
+            else:
+                self._held.setdefault(group, []).append(key)
+        return selected
+
+    def mark_passed(self, keys: Iterable[int]) -> None:
+        self._passed.update(self.group_of(key) for key in keys)
+
+    @property
+    def held(self) -> int:
+        return sum(len(members) for members in self._held.values())
+
+    def expansions(self) -> Tuple[List[int], int, int]:
+        """取出代表通过的分组的暂存成员，返回 (待测IP, 跳过的分组数, 跳过的IP数)；其余暂存成员随之丢弃。"""
+        expanded: List[int] = []
+        skipped_groups = skipped = 0
+        for group, members in self._held.items():
+            if group in self._passed:
+                expanded.extend(members)
+            else:
+                skipped_groups += 1
+                skipped += len(members)
+        self._held.clear()
+        return expanded, skipped_groups, skipped
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""测试公共设置：把仓库根目录加入导入路径，并提供本机 HTTP 服务。"""
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Type
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def http_server():
+    """以给定的处理类在 127.0.0.1 的随机端口上启动 HTTP 服务，返回 (地址, 端口)。"""
+    servers = []
+
+    def start(handler: Type[BaseHTTPRequestHandler]):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.server_address
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def closed_port() -> int:
+    """一个当前无人监听的本机端口。"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
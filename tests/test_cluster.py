@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""coordinator 的租约流程：领取、交回结果、失联后重新分配与迟到结果的处理。"""
+import threading
+import time
+
+import pytest
+import requests
+
+import cluster
+
+TOKEN = "secret"
+
+
+@pytest.fixture
+def coordinator(monkeypatch):
+    monkeypatch.setattr(cluster, "LONG_POLL_SECONDS", 3)
+    coordinator = cluster.Coordinator("127.0.0.1", 0, TOKEN, lease_timeout=1, params={"speedtest": 2})
+    coordinator.start()
+    yield coordinator
+    coordinator.stop()
+
+
+def post(coordinator, path, token=TOKEN, **payload):
+    return requests.post(coordinator.address + path, json=payload, headers={"X-Cluster-Token": token}, timeout=10)
+
+
+def submit(coordinator, tmp_path, lines):
+    """在后台线程中提交批次，返回 (线程, 输出路径, 结果容器, 领取次数记录)。"""
+    out_path = tmp_path / "batch.csv"
+    outcome, leases = {}, []
+
+    def target():
+        try:
+            coordinator.run(lines, out_path, threading.Event(), lambda: leases.append(time.time()))
+            outcome["ok"] = True
+        except cluster.BatchFailed as e:
+            outcome["error"] = str(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread, out_path, outcome, leases
+
+
+def test_rejects_wrong_token(coordinator):
+    assert post(coordinator, "/lease", token="wrong", worker="w1").status_code == 403
+
+
+def test_lease_and_result(coordinator, tmp_path):
+    thread, out_path, outcome, leases = submit(coordinator, tmp_path, ["1.1.1.1 443"])
+    task = post(coordinator, "/lease", worker="w1").json()
+    assert task["lines"] == ["1.1.1.1 443"] and task["params"] == {"speedtest": 2}
+    assert len(leases) == 1
+    assert post(coordinator, "/result", worker="w1", task=task["task"], csv="IP地址\n1.1.1.1\n").json()["accepted"]
+    thread.join(5)
+    assert outcome == {"ok": True}
+    assert out_path.read_text(encoding="utf-8") == "IP地址\n1.1.1.1\n"
+
+
+def test_expired_lease_is_reassigned(coordinator, tmp_path):
+    thread, out_path, outcome, leases = submit(coordinator, tmp_path, ["2.2.2.2 443"])
+    first = post(coordinator, "/lease", worker="w1").json()
+    # w1 不再续约，租约过期后批次交给 w2
+    second = post(coordinator, "/lease", worker="w2").json()
+    assert second["task"] == first["task"]
+    assert len(leases) == 2
+    assert post(coordinator, "/heartbeat", worker="w1", tasks=[first["task"]]).json()["cancel"] == [first["task"]]
+    assert not post(coordinator, "/result", worker="w1", task=first["task"], csv="late\n").json()["accepted"]
+    assert post(coordinator, "/result", worker="w2", task=second["task"], csv="fresh\n").json()["accepted"]
+    thread.join(5)
+    assert outcome == {"ok": True}
+    assert out_path.read_text(encoding="utf-8") == "fresh\n"
+
+
+def test_worker_error_fails_batch(coordinator, tmp_path):
+    thread, _, outcome, _ = submit(coordinator, tmp_path, ["3.3.3.3 443"])
+    task = post(coordinator, "/lease", worker="w1").json()
+    post(coordinator, "/result", worker="w1", task=task["task"], error="iptest crashed")
+    thread.join(5)
+    assert "iptest crashed" in outcome["error"]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""模式二下载缓存：条件请求、断点续传 (含已完整的 .part 与上游变化) 以及损坏缓存的处理。"""
+import json
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import cmip_downloader
+from endpoints import EndpointSet
+
+
+class ZipHandler(BaseHTTPRequestHandler):
+    body = b"0123456789" * 1000
+    etag = '"v1"'
+    seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        type(self).seen.append(dict(self.headers))
+        body, etag = type(self).body, type(self).etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") in (None, etag):
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch, http_server):
+    monkeypatch.setattr(cmip_downloader, "CACHE_META_JSON", tmp_path / "cache_meta.json")
+    monkeypatch.setattr(cmip_downloader, "CANDIDATES_CACHE", tmp_path / "candidates.bin")
+    ZipHandler.body, ZipHandler.etag, ZipHandler.seen = b"0123456789" * 1000, '"v1"', []
+    host, port = http_server(ZipHandler)
+    return f"http://{host}:{port}/cmip.zip", tmp_path / "download.zip"
+
+
+def write_partial(url, dest, data, etag):
+    dest.with_name(dest.name + ".part").write_bytes(data)
+    cmip_downloader.save_cache_meta({"url": url, "partial": {"etag": etag, "last_modified": None}})
+
+
+def test_conditional_request_after_full_download(cache):
+    url, dest = cache
+    assert cmip_downloader.download_file(url, dest) == "downloaded"
+    assert dest.read_bytes() == ZipHandler.body
+    EndpointSet([1, 2]).save(cmip_downloader.CANDIDATES_CACHE)
+    assert cmip_downloader.download_file(url, dest) == "not_modified"
+    assert ZipHandler.seen[-1]["If-None-Match"] == '"v1"'
+
+
+def test_resume_partial_download(cache):
+    url, dest = cache
+    write_partial(url, dest, ZipHandler.body[:4000], '"v1"')
+    assert cmip_downloader.download_file(url, dest) == "downloaded"
+    assert ZipHandler.seen[-1]["Range"] == "bytes=4000-"
+    assert dest.read_bytes() == ZipHandler.body
+    assert json.loads(cmip_downloader.CACHE_META_JSON.read_text())["etag"] == '"v1"'
+
+
+def test_complete_partial_answered_with_416(cache):
+    url, dest = cache
+    write_partial(url, dest, ZipHandler.body, '"v1"')
+    assert cmip_downloader.download_file(url, dest) == "downloaded"
+    assert len(ZipHandler.seen) == 1
+    assert dest.read_bytes() == ZipHandler.body
+
+
+def test_stale_partial_restarts_when_upstream_changed(cache):
+    url, dest = cache
+    write_partial(url, dest, b"old-bytes", '"v0"')
+    assert cmip_downloader.download_file(url, dest) == "downloaded"
+    assert dest.read_bytes() == ZipHandler.body
+
+
+def test_truncated_candidate_cache_is_a_miss(cache):
+    cmip_downloader.CANDIDATES_CACHE.write_bytes(b"\0" * 12)
+    assert cmip_downloader.load_cached_candidates() is None
+
+
+def test_save_replaces_atomically(tmp_path):
+    path = tmp_path / "keys.bin"
+    EndpointSet([3, 1, 2]).save(path)
+    assert list(EndpointSet.load(path)) == [1, 2, 3]
+    assert [p.name for p in tmp_path.iterdir()] == ["keys.bin"]
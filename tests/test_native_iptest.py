@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""内置测速器：对本机 HTTP 替身完成延迟、trace 与下载测速，以及 TCP 预筛。"""
+import csv
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import native_iptest
+
+PAYLOAD = b"x" * (256 * 1024)
+
+
+class SpeedHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == native_iptest.TRACE_PATH:
+            body = b"fl=1\nip=127.0.0.1\ncolo=LAX\n"
+        elif self.path == "/__down":
+            body = PAYLOAD
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(autouse=True)
+def offline_locations(monkeypatch):
+    monkeypatch.setattr(native_iptest, "_locations_cache",
+                        {"LAX": {"region": "North America", "cca2": "US", "city": "Los Angeles"}})
+
+
+def run_batch(tmp_path, endpoints, **overrides):
+    in_path, out_path = tmp_path / "batch.txt", tmp_path / "batch.csv"
+    in_path.write_text("".join(f"{ip} {port}\n" for ip, port in endpoints), encoding="utf-8")
+    params = dict(url="speed.example.com/__down", max_conn=10, speedtest=2, speedlimit=0,
+                  delay_ms=1000, http_timeout=2, download_seconds=1)
+    params.update(overrides)
+    count = native_iptest.run_batch_file(in_path, out_path, **params)
+    with out_path.open(encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    return count, rows
+
+
+def test_batch_against_local_stand_in(tmp_path, http_server, closed_port):
+    _, port = http_server(SpeedHandler)
+    count, rows = run_batch(tmp_path, [("127.0.0.1", port), ("127.0.0.1", closed_port)])
+    assert count == 1
+    assert rows[0] == native_iptest.CSV_HEADER
+    ip, out_port, tls, colo, _, code, _, latency, speed = rows[1]
+    assert (ip, int(out_port), tls, colo, code) == ("127.0.0.1", port, "false", "LAX", "US")
+    assert latency.endswith(" ms")
+    assert float(speed) > 0
+
+
+def test_speed_limit_rejects_slow_results(tmp_path, http_server):
+    _, port = http_server(SpeedHandler)
+    count, rows = run_batch(tmp_path, [("127.0.0.1", port)], speedlimit=1e9)
+    assert count == 0 and len(rows) == 1
+
+
+def test_latency_only_without_download(tmp_path, http_server):
+    _, port = http_server(SpeedHandler)
+    count, rows = run_batch(tmp_path, [("127.0.0.1", port)], speedtest=0)
+    assert count == 1 and rows[1][8] == ""
+
+
+def test_tcp_prefilter_keeps_only_listening_ports(http_server, closed_port):
+    _, port = http_server(SpeedHandler)
+    alive = native_iptest.tcp_prefilter([("127.0.0.1", port), ("127.0.0.1", closed_port)], 10, 1000, 5)
+    assert alive == [("127.0.0.1", port)]